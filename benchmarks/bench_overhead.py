@@ -0,0 +1,362 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/dowhen/blob/master/NOTICE
+
+"""
+Overhead of dowhen compared to the uninstrumented code, for the common
+trigger and callback combinations, and the cost of registering and removing
+handlers at scale.
+
+Usage: python benchmarks/bench_overhead.py [--iterations N] [--scales 10,1000]
+                                           [--json FILE] [scenario ...]
+
+The scenarios can be selected by name prefix, e.g. "line/" or "sampling/".
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+
+import dowhen
+
+
+def hot(n):
+    x = 0
+    for i in range(n):
+        x += i
+    return x
+
+
+def call_hot(n):
+    for _ in range(n):
+        noop()
+
+
+def noop():
+    return None
+
+
+class Hot:
+    def hot(self, n):
+        x = 0
+        for i in range(n):
+            x += i
+        return x
+
+    def helper(self):
+        return None
+
+
+def callback():
+    pass
+
+
+def callback_x(x):
+    pass
+
+
+def condition_x(x):
+    return x >= 0
+
+
+def best_of(func, n, repeat=5):
+    best = float("inf")
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            func(n)
+            best = min(best, time.perf_counter_ns() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+
+def measure(func, n, install, after_install=None):
+    baseline = best_of(func, n)
+    handler = install()
+    if after_install is not None:
+        after_install(handler)
+    instrumented = best_of(func, n)
+    handler.remove()
+    return {
+        "baseline_ns": baseline / n,
+        "instrumented_ns": instrumented / n,
+        "overhead_ns": (instrumented - baseline) / n,
+    }
+
+
+def hot_method(n):
+    return Hot().hot(n)
+
+
+class HandlerGroup:
+    """
+    Several handlers measured together as one scenario.
+    """
+
+    def __init__(self, *handlers):
+        self.handlers = handlers
+
+    def remove(self):
+        for handler in self.handlers:
+            handler.remove()
+
+
+HOT_LINE = hot.__code__.co_firstlineno + 3
+
+
+class BareLineCallback:
+    """
+    A sys.monitoring LINE callback on the hot line that does nothing, the
+    lower bound of a line event. The other lines are disabled, the same as
+    dowhen does.
+    """
+
+    tool_id = 5
+
+    def __init__(self):
+        E = sys.monitoring.events
+        sys.monitoring.use_tool_id(self.tool_id, "bare")
+        sys.monitoring.register_callback(self.tool_id, E.LINE, self)
+        sys.monitoring.set_local_events(self.tool_id, hot.__code__, E.LINE)
+        sys.monitoring.restart_events()
+
+    def __call__(self, code, line_number):
+        if line_number != HOT_LINE:
+            return sys.monitoring.DISABLE
+
+    def remove(self):
+        E = sys.monitoring.events
+        sys.monitoring.set_local_events(self.tool_id, hot.__code__, E.NO_EVENTS)
+        sys.monitoring.register_callback(self.tool_id, E.LINE, None)
+        sys.monitoring.free_tool_id(self.tool_id)
+
+
+SCENARIOS = [
+    # name, measured function, handler factory, what to do with the handler
+    ("line/bare sys.monitoring", hot, BareLineCallback, None),
+    ("line/string", hot, lambda: dowhen.when(hot, "x += i").do("pass"), None),
+    ("line/callable", hot, lambda: dowhen.when(hot, "x += i").do(callback), None),
+    (
+        "line/callable+locals",
+        hot,
+        lambda: dowhen.when(hot, "x += i").do(callback_x),
+        None,
+    ),
+    (
+        "line/string+string condition",
+        hot,
+        lambda: dowhen.when(hot, "x += i", condition="x >= 0").do("pass"),
+        None,
+    ),
+    (
+        "line/callable+callable condition",
+        hot,
+        lambda: dowhen.when(hot, "x += i", condition=condition_x).do(callback_x),
+        None,
+    ),
+    ("line/every line", hot, lambda: dowhen.when(hot).do(callback), None),
+    (
+        "line/callable+every line",
+        hot,
+        lambda: HandlerGroup(
+            dowhen.when(hot, "x += i").do(callback), dowhen.when(hot).do(callback)
+        ),
+        None,
+    ),
+    (
+        "start/string",
+        call_hot,
+        lambda: dowhen.when(noop, "<start>").do("pass"),
+        None,
+    ),
+    (
+        "start/callable",
+        call_hot,
+        lambda: dowhen.when(noop, "<start>").do(callback),
+        None,
+    ),
+    (
+        "return/string",
+        call_hot,
+        lambda: dowhen.when(noop, "<return>").do("pass"),
+        None,
+    ),
+    (
+        "return/callable",
+        call_hot,
+        lambda: dowhen.when(noop, "<return>").do(callback),
+        None,
+    ),
+    (
+        "call/callable",
+        call_hot,
+        lambda: dowhen.when(call_hot, f"<call:{__name__}.noop>").do(callback),
+        None,
+    ),
+    (
+        "call/other callee",
+        call_hot,
+        lambda: dowhen.when(call_hot, "<call:len>").do(callback),
+        None,
+    ),
+    (
+        "module/line",
+        hot,
+        lambda: dowhen.when(sys.modules[__name__], "x += i").do(callback),
+        None,
+    ),
+    (
+        "class/line",
+        hot_method,
+        lambda: dowhen.when(Hot, "x += i").do(callback),
+        None,
+    ),
+    (
+        "global/line",
+        hot,
+        lambda: dowhen.when(None, "x += i").do(callback),
+        None,
+    ),
+    (
+        "global/start",
+        call_hot,
+        lambda: dowhen.when(None, "<start>").do(callback),
+        None,
+    ),
+    (
+        "sampling/every 1000",
+        hot,
+        lambda: dowhen.when(hot, "x += i", sample_every=1000).do(callback),
+        None,
+    ),
+    (
+        "sampling/rate 0.001",
+        hot,
+        lambda: dowhen.when(hot, "x += i", sample_rate=0.001).do(callback),
+        None,
+    ),
+    (
+        "sampling/every 1000+thread_filter",
+        hot,
+        lambda: dowhen.when(
+            hot, "x += i", sample_every=1000, thread_filter=lambda thread: True
+        ).do(callback),
+        None,
+    ),
+    (
+        "disabled/line",
+        hot,
+        lambda: dowhen.when(hot, "x += i").do(callback),
+        lambda handler: handler.disable(),
+    ),
+    (
+        "removed/line",
+        hot,
+        lambda: dowhen.when(hot, "x += i").do(callback),
+        lambda handler: handler.remove(),
+    ),
+]
+
+
+def make_functions(count):
+    namespace: dict = {}
+    source = "\n".join(f"def f{i}():\n    return {i}\n" for i in range(count))
+    exec(compile(source, "<bench>", "exec"), namespace)
+    return [namespace[f"f{i}"] for i in range(count)]
+
+
+def measure_registration(scale, functions, use_batch):
+    start = time.perf_counter_ns()
+    if use_batch:
+        with dowhen.batch():
+            handlers = [
+                dowhen.when(functions[i % len(functions)], "<start>").do(callback)
+                for i in range(scale)
+            ]
+    else:
+        handlers = [
+            dowhen.when(functions[i % len(functions)], "<start>").do(callback)
+            for i in range(scale)
+        ]
+    register = time.perf_counter_ns() - start
+
+    start = time.perf_counter_ns()
+    if use_batch:
+        with dowhen.batch():
+            for handler in handlers:
+                handler.remove()
+    else:
+        for handler in handlers:
+            handler.remove()
+    remove = time.perf_counter_ns() - start
+
+    return {
+        "scale": scale,
+        "batch": use_batch,
+        "register_ns": register / scale,
+        "remove_ns": remove / scale,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=50_000)
+    parser.add_argument(
+        "--scales",
+        default="10,1000,100000",
+        help="comma separated numbers of handlers to register and remove, "
+        "empty to skip",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        help="only run the scenarios whose names start with these prefixes",
+    )
+    args = parser.parse_args()
+
+    n = args.iterations
+    results = {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "dowhen": dowhen.__version__,
+        "iterations": n,
+        "scenarios": {},
+        "registration": [],
+    }
+
+    print(f"Python {results['python']}, {n} events per scenario")
+    for name, func, install, after_install in SCENARIOS:
+        if args.scenarios and not name.startswith(tuple(args.scenarios)):
+            continue
+        result = measure(func, n, install, after_install)
+        results["scenarios"][name] = result
+        print(f"{name:<36}{result['overhead_ns']:>10.1f} ns/event")
+
+    # Handlers are spread over a pool of functions so the per code
+    # dispatch entries stay at a realistic size
+    functions = make_functions(1000)
+    for scale in (int(scale) for scale in args.scales.split(",") if scale):
+        for use_batch in (False, True):
+            result = measure_registration(scale, functions, use_batch)
+            results["registration"].append(result)
+            label = f"register {scale}" + (" (batch)" if use_batch else "")
+            print(
+                f"{label:<36}{result['register_ns']:>10.0f} ns/handler"
+                f"{result['remove_ns']:>12.0f} ns/remove"
+            )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
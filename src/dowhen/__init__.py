@@ -4,9 +4,44 @@
 
 __version__ = "0.1.0"
 
-from .callback import bp, do, goto
+from .callback import bp, capture, do, goto, log
+from .eventlog import EventLog, EventRecord, read_event_log
 from .instrumenter import DISABLE
+from .probes import load_probes
+from .scope import Scope
 from .trigger import when
-from .util import clear_all, get_source_hash
+from .util import (
+    batch,
+    clear_all,
+    configure_deferred,
+    disable_stats,
+    enable_stats,
+    flush_deferred,
+    get_source_hash,
+    stats,
+    verify_source_hashes,
+)
 
-__all__ = ["bp", "clear_all", "do", "get_source_hash", "goto", "when", "DISABLE"]
+__all__ = [
+    "batch",
+    "bp",
+    "capture",
+    "clear_all",
+    "configure_deferred",
+    "disable_stats",
+    "do",
+    "enable_stats",
+    "flush_deferred",
+    "get_source_hash",
+    "goto",
+    "load_probes",
+    "log",
+    "read_event_log",
+    "stats",
+    "verify_source_hashes",
+    "when",
+    "DISABLE",
+    "EventLog",
+    "EventRecord",
+    "Scope",
+]
@@ -0,0 +1,97 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/dowhen/blob/master/NOTICE
+
+"""
+Run a script or a module with the probes of the spec files installed.
+
+Usage: python -m dowhen --probes spec.toml [--line-cache FILE] script.py [args]
+       python -m dowhen --probes spec.toml [--line-cache FILE] -m module [args]
+"""
+
+import argparse
+import os
+import runpy
+import sys
+
+from .instrumenter import Instrumenter
+from .probes import load_probes
+from .util import LineNumberCache
+
+
+def get_default_line_cache() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "dowhen", "lines.json")
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m dowhen", description=__doc__.strip().split("\n\n")[0]
+    )
+    parser.add_argument(
+        "--probes",
+        action="append",
+        required=True,
+        metavar="SPEC",
+        help="TOML or JSON probe spec, can be given multiple times",
+    )
+    parser.add_argument(
+        "--line-cache",
+        default=get_default_line_cache(),
+        metavar="FILE",
+        help="file to cache the resolved line numbers between runs",
+    )
+    parser.add_argument(
+        "--no-line-cache",
+        action="store_true",
+        help="do not cache the resolved line numbers",
+    )
+    parser.add_argument(
+        "-m",
+        dest="module",
+        nargs=argparse.REMAINDER,
+        help="run the module as a script, followed by its arguments",
+    )
+    parser.add_argument(
+        "script", nargs=argparse.REMAINDER, help="the script and its arguments"
+    )
+    args = parser.parse_args(argv)
+
+    if args.module:
+        target, target_args = args.module[0], args.module[1:]
+    elif args.script:
+        target, target_args = args.script[0], args.script[1:]
+    else:
+        parser.error("a script or -m module is required")
+
+    cache = None
+    if not args.no_line_cache:
+        # Installed for the whole run, so the probes that are resolved when
+        # their modules are imported are cached as well
+        cache = LineNumberCache(args.line_cache)
+        cache.install()
+
+    sys.argv = [target, *target_args]
+    if not args.module:
+        # Set before the probes are loaded, so their modules next to the
+        # script can be found
+        sys.path[0] = os.path.dirname(os.path.abspath(target))
+
+    try:
+        with Instrumenter().batch():
+            for spec in args.probes:
+                load_probes(spec)
+
+        if args.module:
+            runpy.run_module(target, run_name="__main__", alter_sys=True)
+        else:
+            runpy.run_path(target, run_name="__main__")
+    finally:
+        if cache is not None:
+            cache.uninstall()
+            cache.save()
+
+
+if __name__ == "__main__":
+    main()
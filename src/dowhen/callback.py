@@ -7,13 +7,17 @@ from __future__ import annotations
 import ctypes
 import inspect
 import sys
+import threading
 import warnings
-from collections.abc import Callable
+from collections.abc import Callable, Iterable, MutableMapping
 from types import CodeType, FrameType, FunctionType, MethodType, ModuleType
 from typing import TYPE_CHECKING, Any
 
+from .deferred import DeferredWorker
+from .eventlog import EventLog
+from .scope import Scope
 from .types import IdentifierType
-from .util import call_in_frame, get_line_numbers
+from .util import CallPlan, RingBuffer, compile_source, get_line_numbers
 
 if TYPE_CHECKING:  # pragma: no cover
     from .handler import EventHandler
@@ -21,55 +25,123 @@ if TYPE_CHECKING:  # pragma: no cover
 
 DISABLE = sys.monitoring.DISABLE
 
+if sys.version_info < (3, 13):
+    LocalsToFast = ctypes.pythonapi.PyFrame_LocalsToFast
+    LocalsToFast.argtypes = [ctypes.py_object, ctypes.c_int]
+
 
 class Callback:
-    def __init__(self, func: str | Callable, **kwargs):
+    def __init__(self, func: str | Callable, deferred: bool = False, **kwargs):
+        if deferred and not (inspect.isfunction(func) or inspect.ismethod(func)):
+            raise TypeError("Only function callbacks can be deferred.")
         if isinstance(func, str):
-            pass
-        elif inspect.isfunction(func):
-            self.func_args = inspect.getfullargspec(func).args
-        elif inspect.ismethod(func):
-            self.func_args = inspect.getfullargspec(func).args
+            if func != "goto":
+                try:
+                    self.code = compile_source(func, "exec")
+                except SyntaxError:
+                    raise ValueError(f"Invalid callback code: {func}")
+            self.needs_locals = self.writes_locals = func != "goto"
+        elif inspect.isfunction(func) or inspect.ismethod(func):
+            self.plan = CallPlan(func)
+            # Before 3.13, changes through _frame.f_locals are synced back
+            # as well, which requires a fresh f_locals
+            self.needs_locals = self.plan.needs_locals or (
+                self.plan.uses_frame and sys.version_info < (3, 13)
+            )
+            self.writes_locals = True
+            if deferred:
+                if self.plan.uses_frame:
+                    raise ValueError(
+                        "Cannot use '_frame' in a deferred callback, "
+                        "the frame is not available when it runs."
+                    )
+                self.needs_locals = self.plan.needs_locals
+                self.writes_locals = False
         else:
             raise TypeError(f"Unsupported callback type: {type(func)}. ")
+        self._init_attributes(func, deferred, **kwargs)
+
+    def _init_attributes(
+        self, func: str | Callable, deferred: bool = False, **kwargs
+    ) -> None:
+        """
+        Set the attributes shared by all the callbacks, the subclasses that
+        don't compile func call this instead of __init__.
+        """
         self.func = func
         self.kwargs = kwargs
+        # Deferred callbacks only bind their arguments in the traced thread
+        # and run in the background worker, the return value is ignored.
+        self.deferred = deferred
+        self.worker = DeferredWorker() if deferred else None
 
-    def __call__(self, frame: FrameType, **kwargs) -> Any:
+    def __call__(
+        self,
+        frame: FrameType,
+        f_locals: MutableMapping[str, Any] | None = None,
+        **kwargs,
+    ) -> Any:
+        """
+        f_locals is the snapshot of frame.f_locals shared by the handler,
+        it is read from the frame if it is not given and needed.
+        """
+        if self.worker is not None:
+            self.worker.submit(
+                self.plan.func, self.plan.bind(frame, f_locals, **kwargs)
+            )
+            return None
         ret = None
         if isinstance(self.func, str):
             if self.func == "goto":  # pragma: no cover
                 self._call_goto(frame)
             else:
-                self._call_code(frame)
+                self._call_code(frame, f_locals)
         elif inspect.isfunction(self.func) or inspect.ismethod(self.func):
-            ret = self._call_function(frame, **kwargs)
+            ret = self._call_function(frame, f_locals, **kwargs)
         else:  # pragma: no cover
             assert False, "Unknown callback type"
 
-        if sys.version_info < (3, 13):
-            LocalsToFast = ctypes.pythonapi.PyFrame_LocalsToFast
-            LocalsToFast.argtypes = [ctypes.py_object, ctypes.c_int]
-            LocalsToFast(frame, 0)
-
         if ret is DISABLE:
             return DISABLE
 
-    def _call_code(self, frame: FrameType) -> None:
-        assert isinstance(self.func, str)
-        exec(self.func, frame.f_globals, frame.f_locals)
+    def _sync_locals(self, frame: FrameType) -> None:
+        if sys.version_info < (3, 13):
+            LocalsToFast(frame, 0)
 
-    def _call_function(self, frame: FrameType, **kwargs) -> Any:
+    def _call_code(
+        self, frame: FrameType, f_locals: MutableMapping[str, Any] | None = None
+    ) -> None:
+        if f_locals is None:
+            f_locals = frame.f_locals
+        exec(self.code, frame.f_globals, f_locals)
+        self._sync_locals(frame)
+
+    def _call_function(
+        self,
+        frame: FrameType,
+        f_locals: MutableMapping[str, Any] | None = None,
+        **kwargs,
+    ) -> Any:
         assert isinstance(self.func, (FunctionType, MethodType))
-        writeback = call_in_frame(self.func, frame, **kwargs)
+        if f_locals is None and self.needs_locals:
+            f_locals = frame.f_locals
+        writeback = self.plan(frame, f_locals, **kwargs)
 
-        f_locals = frame.f_locals
         if isinstance(writeback, dict):
+            if f_locals is None:
+                f_locals = frame.f_locals
             for arg, val in writeback.items():
                 if arg not in f_locals:
                     raise TypeError(f"Argument '{arg}' not found in frame locals.")
                 f_locals[arg] = val
-        elif writeback is DISABLE:
+            self._sync_locals(frame)
+            return None
+
+        if self.plan.uses_frame:
+            # The callback might have changed _frame.f_locals directly
+            self._sync_locals(frame)
+
+        if writeback is DISABLE:
             return DISABLE
         elif writeback is not None:
             raise TypeError(
@@ -109,13 +181,21 @@ class Callback:
             frame.f_lineno = line_number  # type: ignore
 
     @classmethod
-    def do(cls, func: str | Callable) -> Callback:
-        return cls(func)
+    def do(cls, func: str | Callable, deferred: bool = False) -> Callback:
+        return cls(func, deferred=deferred)
 
     @classmethod
     def goto(cls, target: str | int) -> Callback:
         return cls("goto", target=target)
 
+    @classmethod
+    def capture(cls, *exprs: str, size: int = 1024) -> Callback:
+        return CaptureCallback(*exprs, size=size)
+
+    @classmethod
+    def log(cls, event_log: EventLog, *exprs: str) -> Callback:
+        return LogCallback(event_log, *exprs)
+
     @classmethod
     def bp(cls) -> Callback:
         def do_breakpoint(_frame: FrameType) -> None:  # pragma: no cover
@@ -135,15 +215,42 @@ class Callback:
 
     def when(
         self,
-        entity: CodeType | FunctionType | MethodType | ModuleType | type | None,
+        entity: CodeType | FunctionType | MethodType | ModuleType | type | str | None,
         *identifiers: IdentifierType | tuple[IdentifierType, ...],
         condition: str | Callable[..., bool | Any] | None = None,
         source_hash: str | None = None,
+        sample_every: int | None = None,
+        sample_rate: float | None = None,
+        max_rate: float | None = None,
+        burst: float | None = None,
+        throttle_disable: bool = False,
+        recursive: bool = False,
+        threads: Iterable[int | threading.Thread] | None = None,
+        thread_filter: Callable[[threading.Thread], bool] | None = None,
+        scope: Scope | None = None,
+        exception: type[BaseException] | tuple[type[BaseException], ...] | None = None,
+        once: bool = False,
+        max_fires: int | None = None,
     ) -> "EventHandler":
         from .trigger import when
 
         trigger = when(
-            entity, *identifiers, condition=condition, source_hash=source_hash
+            entity,
+            *identifiers,
+            condition=condition,
+            source_hash=source_hash,
+            sample_every=sample_every,
+            sample_rate=sample_rate,
+            max_rate=max_rate,
+            burst=burst,
+            throttle_disable=throttle_disable,
+            recursive=recursive,
+            threads=threads,
+            thread_filter=thread_filter,
+            scope=scope,
+            exception=exception,
+            once=once,
+            max_fires=max_fires,
         )
 
         from .handler import EventHandler
@@ -154,6 +261,88 @@ class Callback:
         return handler
 
 
+def compile_exprs(exprs: tuple[str, ...]) -> CodeType:
+    """
+    Compile the expressions into one expression of their tuple.
+    """
+    for expr in exprs:
+        if not isinstance(expr, str):
+            raise TypeError(f"Expression must be a string, got {type(expr)}")
+        try:
+            compile_source(expr, "eval")
+        except SyntaxError:
+            raise ValueError(f"Invalid expression: {expr}")
+    return compile_source("(" + "".join(f"({expr}), " for expr in exprs) + ")", "eval")
+
+
+class CaptureCallback(Callback):
+    """
+    Record the values of the expressions into a ring buffer, as a tuple
+    per hit. All the expressions are evaluated with a single eval().
+    """
+
+    def __init__(self, *exprs: str, size: int = 1024):
+        if not exprs:
+            raise ValueError("capture needs at least one expression.")
+        if not isinstance(size, int) or isinstance(size, bool):
+            raise TypeError(f"size must be an integer, got {type(size)}")
+        if size < 1:
+            raise ValueError("size must be a positive integer.")
+        self.code = compile_exprs(exprs)
+        self.exprs = exprs
+        self.buffer = RingBuffer(size)
+        self._init_attributes("capture")
+        self.needs_locals = True
+        self.writes_locals = False
+
+    def __call__(
+        self,
+        frame: FrameType,
+        f_locals: MutableMapping[str, Any] | None = None,
+        **kwargs,
+    ) -> Any:
+        if f_locals is None:
+            f_locals = frame.f_locals
+        self.buffer.append(eval(self.code, frame.f_globals, f_locals))
+
+    def drain(self) -> list[tuple]:
+        return self.buffer.drain()
+
+
+class LogCallback(Callback):
+    """
+    Write the event, with the values of the expressions, to an EventLog.
+    """
+
+    def __init__(self, event_log: EventLog, *exprs: str):
+        if not isinstance(event_log, EventLog):
+            raise TypeError(f"Expected an EventLog, got {type(event_log)}")
+        self.values_code = compile_exprs(exprs) if exprs else None
+        self.exprs = exprs
+        self.event_log = event_log
+        self.probe_id = event_log.add_probe(exprs)
+        self._init_attributes("log")
+        self.needs_locals = bool(exprs)
+        self.writes_locals = False
+
+    def __call__(
+        self,
+        frame: FrameType,
+        f_locals: MutableMapping[str, Any] | None = None,
+        **kwargs,
+    ) -> Any:
+        values = ()
+        if self.values_code is not None:
+            if f_locals is None:
+                f_locals = frame.f_locals
+            values = eval(self.values_code, frame.f_globals, f_locals)
+        self.event_log.write(
+            self.probe_id, frame.f_code, frame.f_lineno, threading.get_ident(), values
+        )
+
+
 bp = Callback.bp
+capture = Callback.capture
 do = Callback.do
 goto = Callback.goto
+log = Callback.log
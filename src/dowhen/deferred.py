@@ -0,0 +1,126 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/dowhen/blob/master/NOTICE
+
+from __future__ import annotations
+
+import atexit
+import threading
+import time
+import warnings
+from collections import deque
+from collections.abc import Callable
+from typing import Any, Literal
+
+OnFullType = Literal["drop_newest", "drop_oldest"]
+
+_start_lock = threading.Lock()
+
+
+class DeferredWorker:
+    """
+    Background thread that runs the deferred callbacks. The traced threads
+    only append the bound arguments to a deque, which is atomic without a
+    lock, and wake up the worker if it's idle.
+    """
+
+    _initialized: bool = False
+    _instance: DeferredWorker
+
+    def __new__(cls, *args, **kwargs) -> DeferredWorker:
+        if not hasattr(cls, "_instance"):
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not self._initialized:
+            self.queue: deque[tuple[Callable, tuple]] = deque()
+            self.maxsize = 65536
+            self.on_full: OnFullType = "drop_newest"
+            self.dropped = 0
+            self._wakeup = threading.Event()
+            self._idle = threading.Event()
+            self._idle.set()
+            self._thread: threading.Thread | None = None
+            self._initialized = True
+
+    def configure(
+        self, maxsize: int | None = None, on_full: OnFullType | None = None
+    ) -> None:
+        if maxsize is not None:
+            if not isinstance(maxsize, int) or isinstance(maxsize, bool):
+                raise TypeError(f"maxsize must be an integer, got {type(maxsize)}")
+            if maxsize < 1:
+                raise ValueError("maxsize must be a positive integer.")
+            self.maxsize = maxsize
+        if on_full is not None:
+            if on_full not in ("drop_newest", "drop_oldest"):
+                raise ValueError(
+                    f"on_full must be 'drop_newest' or 'drop_oldest', got {on_full!r}"
+                )
+            self.on_full = on_full
+
+    def submit(self, func: Callable, args: tuple) -> None:
+        queue = self.queue
+        if len(queue) >= self.maxsize:
+            self.dropped += 1
+            if self.on_full == "drop_newest":
+                return
+            try:
+                queue.popleft()
+            except IndexError:  # pragma: no cover
+                # The worker emptied the queue in the meantime
+                pass
+        queue.append((func, args))
+        if self._thread is None:
+            self._start()
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """
+        Wait until all the submitted callbacks are done. Return False if
+        it timed out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue or not self._idle.is_set():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._idle.wait(remaining)
+            if self.queue:
+                # Items might be appended after the worker became idle
+                time.sleep(0.001)
+        return True
+
+    def _start(self) -> None:
+        with _start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="dowhen-deferred", daemon=True
+                )
+                self._thread.start()
+                # Run what's left when the interpreter exits
+                atexit.register(self.flush, 1.0)
+
+    def _run(self) -> None:  # pragma: no cover
+        queue = self.queue
+        while True:
+            self._wakeup.wait()
+            self._idle.clear()
+            self._wakeup.clear()
+            while True:
+                try:
+                    func, args = queue.popleft()
+                except IndexError:
+                    break
+                self._call(func, args)
+            self._idle.set()
+
+    def _call(self, func: Callable, args: tuple) -> Any:
+        try:
+            func(*args)
+        except Exception as e:
+            warnings.warn(
+                f"dowhen deferred callback {func.__qualname__} raised {e!r}",
+                RuntimeWarning,
+            )
@@ -0,0 +1,267 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/dowhen/blob/master/NOTICE
+
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+import threading
+import time
+from collections.abc import Iterator
+from types import CodeType
+from typing import Any, NamedTuple
+
+MAGIC = b"DOWHEN\x00\x01"
+
+# Every record starts with its kind, the rest of the file is zeros
+END = 0
+EVENT = 1
+CODE = 2
+PROBE = 3
+
+# kind, number of values, probe id, code id, line number, time_ns, thread id
+EVENT_HEADER = "<BBHIiqQ"
+# kind, code id, first line number, length of "qualname\0filename"
+CODE_HEADER = struct.Struct("<BIiH")
+# kind, probe id, length of the expressions joined by "\0"
+PROBE_HEADER = struct.Struct("<BHH")
+
+# Each value is a tag and 8 bytes
+VALUE_FORMATS = {
+    type(None): ("B8x", 0),
+    int: ("Bq", 1),
+    float: ("Bd", 2),
+    bool: ("Bq", 3),
+}
+VALUE_SIZE = 9
+VALUE_TAGS = {tag: fmt for fmt, tag in VALUE_FORMATS.values()}
+
+
+class EventRecord(NamedTuple):
+    timestamp_ns: int
+    probe_id: int
+    exprs: tuple[str, ...]
+    filename: str
+    qualname: str
+    line_number: int
+    thread_id: int
+    values: tuple[Any, ...]
+
+
+class EventLog:
+    """
+    Binary log of events in a memory-mapped file. A record is packed into
+    the mapping with a precompiled struct, so writing one doesn't format
+    any string. The code objects and the probes are written once, as
+    definition records, and the events refer to them by id.
+    """
+
+    def __init__(self, path: str | os.PathLike, size: int = 64 * 1024 * 1024):
+        if not isinstance(size, int) or isinstance(size, bool):
+            raise TypeError(f"size must be an integer, got {type(size)}")
+        if size < len(MAGIC):
+            raise ValueError(f"size must be at least {len(MAGIC)} bytes.")
+        self.path = path
+        self.size = size
+        with open(path, "w+b") as f:
+            f.truncate(size)
+            self.mmap = mmap.mmap(f.fileno(), size)
+        self.mmap[: len(MAGIC)] = MAGIC
+        self.offset = len(MAGIC)
+        self.closed = False
+        # Number of records that did not fit in the file
+        self.dropped = 0
+        self._lock = threading.Lock()
+        # id() of the code object -> code id, the code objects are kept
+        # alive so the ids are not reused
+        self._code_ids: dict[int, int] = {}
+        self._codes: list[CodeType] = []
+        self._probe_count = 0
+        # Struct of an event keyed by the types of its values
+        self._event_structs: dict[tuple[type, ...], struct.Struct] = {}
+
+    def __enter__(self) -> EventLog:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def flush(self) -> None:
+        if not self.closed:
+            self.mmap.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if not self.closed:
+                self.mmap.flush()
+                self.mmap.close()
+                self.closed = True
+
+    def _reserve(self, size: int) -> int:
+        # Called with the lock held, the offset is -1 if the record doesn't fit
+        offset = self.offset
+        if self.closed or offset + size > self.size:
+            self.dropped += 1
+            return -1
+        self.offset = offset + size
+        return offset
+
+    def _append(self, record: bytes) -> bool:
+        # Called with the lock held. The records are packed before they
+        # are appended, so a value that can't be packed leaves no trace.
+        offset = self._reserve(len(record))
+        if offset < 0:
+            return False
+        self.mmap[offset : offset + len(record)] = record
+        return True
+
+    def add_probe(self, exprs: tuple[str, ...]) -> int:
+        """
+        Write the definition of a probe and return its id.
+        """
+        data = "\0".join(exprs).encode("utf-8")
+        with self._lock:
+            probe_id = self._probe_count + 1
+            try:
+                record = PROBE_HEADER.pack(PROBE, probe_id, len(data)) + data
+            except struct.error:
+                raise ValueError(
+                    "The event log can't hold more probes or expressions this long."
+                ) from None
+            self._probe_count = probe_id
+            self._append(record)
+        return probe_id
+
+    def _add_code(self, code: CodeType) -> int:
+        # Called with the lock held
+        code_id = len(self._codes) + 1
+        data = f"{code.co_qualname}\0{code.co_filename}".encode("utf-8", "replace")
+        try:
+            record = (
+                CODE_HEADER.pack(CODE, code_id, code.co_firstlineno, len(data)) + data
+            )
+        except struct.error:
+            self.dropped += 1
+            return 0
+        if not self._append(record):
+            return 0
+        self._code_ids[id(code)] = code_id
+        self._codes.append(code)
+        return code_id
+
+    def _get_event_struct(self, types: tuple[type, ...]) -> struct.Struct:
+        event_struct = self._event_structs.get(types)
+        if event_struct is None:
+            try:
+                formats = "".join(VALUE_FORMATS[t][0] for t in types)
+            except KeyError as e:
+                raise TypeError(
+                    f"Only None, int, float and bool can be logged, got {e.args[0]}"
+                ) from None
+            event_struct = struct.Struct(EVENT_HEADER + formats)
+            self._event_structs[types] = event_struct
+        return event_struct
+
+    def write(
+        self,
+        probe_id: int,
+        code: CodeType,
+        line_number: int,
+        thread_id: int,
+        values: tuple[Any, ...] = (),
+    ) -> None:
+        types = tuple(map(type, values))
+        event_struct = self._event_structs.get(types) or self._get_event_struct(types)
+        args: list[Any] = []
+        for value_type, value in zip(types, values):
+            args.append(VALUE_FORMATS[value_type][1])
+            if value is not None:
+                args.append(value)
+        timestamp = time.time_ns()
+        with self._lock:
+            code_id = self._code_ids.get(id(code)) or self._add_code(code)
+            try:
+                record = event_struct.pack(
+                    EVENT,
+                    len(values),
+                    probe_id,
+                    code_id,
+                    line_number,
+                    timestamp,
+                    thread_id,
+                    *args,
+                )
+            except struct.error:
+                # The values don't fit in the record, e.g. an int over 64 bits,
+                # the event is dropped instead of raising in the traced code
+                self.dropped += 1
+                return
+            self._append(record)
+
+
+def read_event_log(path: str | os.PathLike) -> Iterator[EventRecord]:
+    """
+    Stream the events of a log written by EventLog.
+    """
+    event_header = struct.Struct(EVENT_HEADER)
+    value_structs = {tag: struct.Struct("<" + fmt) for tag, fmt in VALUE_TAGS.items()}
+    codes: dict[int, tuple[str, str]] = {0: ("", "")}
+    probes: dict[int, tuple[str, ...]] = {}
+
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a dowhen event log.")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = len(MAGIC)
+            size = len(data)
+            while offset < size:
+                kind = data[offset]
+                if kind == EVENT:
+                    (
+                        _,
+                        count,
+                        probe_id,
+                        code_id,
+                        line_number,
+                        timestamp,
+                        thread_id,
+                    ) = event_header.unpack_from(data, offset)
+                    offset += event_header.size
+                    values: list[Any] = []
+                    for _ in range(count):
+                        tag = data[offset]
+                        value = value_structs[tag].unpack_from(data, offset)[1:]
+                        if tag == 0:
+                            values.append(None)
+                        elif tag == 3:
+                            values.append(bool(value[0]))
+                        else:
+                            values.append(value[0])
+                        offset += VALUE_SIZE
+                    qualname, filename = codes[code_id]
+                    yield EventRecord(
+                        timestamp,
+                        probe_id,
+                        probes.get(probe_id, ()),
+                        filename,
+                        qualname,
+                        line_number,
+                        thread_id,
+                        tuple(values),
+                    )
+                elif kind == CODE:
+                    _, code_id, _, length = CODE_HEADER.unpack_from(data, offset)
+                    offset += CODE_HEADER.size
+                    text = data[offset : offset + length].decode("utf-8")
+                    qualname, _, filename = text.partition("\0")
+                    codes[code_id] = (qualname, filename)
+                    offset += length
+                elif kind == PROBE:
+                    _, probe_id, length = PROBE_HEADER.unpack_from(data, offset)
+                    offset += PROBE_HEADER.size
+                    text = data[offset : offset + length].decode("utf-8")
+                    probes[probe_id] = tuple(text.split("\0")) if text else ()
+                    offset += length
+                else:
+                    break
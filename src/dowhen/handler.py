@@ -5,57 +5,268 @@
 from __future__ import annotations
 
 import sys
-from types import FrameType
+import threading
+import time
+from types import CodeType, FrameType
 from typing import Any, Callable
 
 from .callback import Callback
+from .eventlog import EventLog
+from .importhook import ImportHook
 from .instrumenter import Instrumenter
 from .trigger import Trigger
+from .util import get_thread_ident
 
 DISABLE = sys.monitoring.DISABLE
 
+# Before 3.13, f_locals is a dict snapshot and PyFrame_LocalsToFast only
+# applies once per read of f_locals, so the snapshot can't be reused by a
+# callback after another callback wrote to it.
+WRITE_INVALIDATES_LOCALS = sys.version_info < (3, 13)
+
+
+class EventStats:
+    """
+    Counters of a handler at a single location.
+    """
+
+    __slots__ = (
+        "code",
+        "line_number",
+        "events",
+        "rejections",
+        "condition_evaluations",
+        "condition_passes",
+        "fires",
+        "condition_ns",
+        "callback_ns",
+    )
+
+    counters = __slots__[2:]
+
+    def __init__(self, code: CodeType | None = None, line_number: int | None = None):
+        self.code = code
+        self.line_number = line_number
+        self.events = 0
+        self.rejections = 0
+        self.condition_evaluations = 0
+        self.condition_passes = 0
+        self.fires = 0
+        self.condition_ns = 0
+        self.callback_ns = 0
+
+    def add(self, other: EventStats) -> None:
+        for counter in self.counters:
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+
+    def as_dict(self) -> dict[str, int]:
+        return {counter: getattr(self, counter) for counter in self.counters}
+
 
 class EventHandler:
+    # Switched for all the handlers by dowhen.enable_stats/disable_stats
+    collect_stats = False
+
+    # With throttle_disable, the handler is only disabled if the next token
+    # is at least this many seconds away, as re-enabling restarts events
+    min_throttle_disable_time = 0.1
+
     def __init__(self, trigger: Trigger, callback: Callback):
         self.trigger = trigger
         self.callbacks: list[Callback] = [callback]
         self.disabled = False
         self.removed = False
+        # Hits left until the next sampled hit, 0 when not sampling
+        self.sample_countdown = trigger.sample_interval()
+        # Token bucket for max_rate, it starts full
+        self.tokens = trigger.burst or 0.0
+        self.tokens_updated = time.monotonic()
+        self.throttle_timer: threading.Timer | None = None
+        # Idents of the threads the handler fires on, None for all threads.
+        # It's replaced, not mutated, so it can be checked without a lock.
+        self.threads = trigger.threads
+        # Fires left before the handler removes itself, None for no limit
+        self.fires_left = trigger.max_fires
+        # EventStats keyed by (id(code), line_number) of the event
+        self.stats: dict[tuple[int, int], EventStats] = {}
 
     def disable(self) -> None:
         if self.removed:
             raise RuntimeError("Cannot disable a removed handler.")
+        self._cancel_throttle_timer()
         self.disabled = True
 
     def enable(self) -> None:
         if self.removed:
             raise RuntimeError("Cannot enable a removed handler.")
+        self._cancel_throttle_timer()
         if self.disabled:
             self.disabled = False
             Instrumenter().restart_events()
 
     def submit(self) -> None:
-        Instrumenter().submit(self)
+        if self.trigger.target is not None:
+            ImportHook().add(self)
+        else:
+            Instrumenter().submit(self)
 
     def remove(self) -> None:
+        self._cancel_throttle_timer()
+        if self.trigger.target is not None:
+            ImportHook().remove(self)
         Instrumenter().remove_handler(self)
         self.removed = True
 
+    def _take_token(self) -> bool:
+        trigger = self.trigger
+        assert trigger.max_rate is not None and trigger.burst is not None
+        now = time.monotonic()
+        tokens = min(
+            trigger.burst, self.tokens + (now - self.tokens_updated) * trigger.max_rate
+        )
+        self.tokens_updated = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return True
+        self.tokens = tokens
+
+        if trigger.throttle_disable:
+            wait = (1 - tokens) / trigger.max_rate
+            if wait >= self.min_throttle_disable_time:
+                # Stop the events until the next token is available
+                self.disabled = True
+                self.throttle_timer = threading.Timer(wait, self._end_throttle)
+                self.throttle_timer.daemon = True
+                self.throttle_timer.start()
+        return False
+
+    def _end_throttle(self) -> None:
+        if self.throttle_timer is not None and not self.removed:
+            self.throttle_timer = None
+            self.enable()
+
+    def _cancel_throttle_timer(self) -> None:
+        if self.throttle_timer is not None:
+            self.throttle_timer.cancel()
+            self.throttle_timer = None
+
+    def add_thread(self, thread: int | threading.Thread | None = None) -> None:
+        """
+        Add a thread, the current thread by default, to the threads the
+        handler fires on. A handler that fires on all threads becomes
+        scoped to the thread.
+        """
+        ident = get_thread_ident(thread)
+        self.threads = (self.threads or frozenset()) | {ident}
+
+    def remove_thread(self, thread: int | threading.Thread | None = None) -> None:
+        """
+        Remove a thread, the current thread by default, from the threads
+        the handler fires on.
+        """
+        if self.threads is None:
+            raise ValueError("The handler is not scoped to threads.")
+        self.threads = self.threads - {get_thread_ident(thread)}
+
+    def get_stats(self) -> dict[str, Any]:
+        total = EventStats()
+        locations = {}
+        for stats in self.stats.values():
+            total.add(stats)
+            locations[(stats.code, stats.line_number)] = stats.as_dict()
+        return {"total": total.as_dict(), "locations": locations}
+
+    def _get_location_stats(self, frame: FrameType) -> EventStats:
+        key = (id(frame.f_code), frame.f_lineno)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = EventStats(frame.f_code, frame.f_lineno)
+        return stats
+
     def __call__(self, frame: FrameType, **kwargs) -> Any:
+        stats = None
+        if self.collect_stats:
+            stats = self._get_location_stats(frame)
+            stats.events += 1
         if not self.disabled:
-            if not self.trigger.has_event(frame):
-                return DISABLE
-            should_fire = self.trigger.should_fire(frame)
+            trigger = self.trigger
+            if trigger.exception is not None and not isinstance(
+                kwargs.get("exception"), trigger.exception
+            ):
+                return None
+            # Sampling goes before the other filters so the skipped hits,
+            # which are most of them, return as early as possible. Only the
+            # checks above, which decide whether the event belongs to the
+            # trigger at all, see every hit.
+            if self.sample_countdown:
+                self.sample_countdown -= 1
+                if self.sample_countdown:
+                    return None
+                self.sample_countdown = trigger.sample_interval()
+            if self.threads is not None and threading.get_ident() not in self.threads:
+                return None
+            if trigger.thread_filter is not None and not trigger.thread_filter(
+                threading.current_thread()
+            ):
+                return None
+            if trigger.scope is not None and not trigger.scope.var.get():
+                return None
+            if trigger.max_rate is not None and not self._take_token():
+                return DISABLE if self.disabled else None
+            # frame.f_locals is read lazily and shared between the condition
+            # and the callbacks
+            f_locals = frame.f_locals if trigger.needs_locals else None
+            if stats is not None:
+                start = time.perf_counter_ns()
+                should_fire = trigger.should_fire(frame, f_locals)
+                stats.condition_ns += time.perf_counter_ns() - start
+                stats.condition_evaluations += 1
+                if should_fire and should_fire is not DISABLE:
+                    stats.condition_passes += 1
+                    stats.fires += len(self.callbacks)
+                start = time.perf_counter_ns()
+            else:
+                should_fire = trigger.should_fire(frame, f_locals)
             if should_fire is DISABLE:
                 self.disable()
             elif should_fire:
                 for cb in self.callbacks:
-                    if cb(frame, **kwargs) is DISABLE:
+                    if f_locals is None and cb.needs_locals:
+                        f_locals = frame.f_locals
+                    if kwargs:
+                        ret = cb.__call__(frame, f_locals, **kwargs)
+                    else:
+                        ret = cb.__call__(frame, f_locals)
+                    if ret is DISABLE:
                         self.disable()
+                    if WRITE_INVALIDATES_LOCALS and cb.writes_locals:
+                        f_locals = None
+                if stats is not None:
+                    stats.callback_ns += time.perf_counter_ns() - start
+                if self.fires_left is not None:
+                    self.fires_left -= 1
+                    if self.fires_left <= 0:
+                        # Removing the handler clears the events of the
+                        # code objects that don't have other handlers
+                        self.remove()
+                        return DISABLE
 
         if self.disabled:
             return DISABLE
 
+    def call_global_line(self, frame: FrameType) -> Any:
+        """
+        Line event of a global trigger with identifiers, the lines that
+        don't match them are rejected and disabled.
+        """
+        if not self.trigger.has_event(frame):
+            if self.collect_stats:
+                stats = self._get_location_stats(frame)
+                stats.events += 1
+                stats.rejections += 1
+            return DISABLE
+        return self.__call__(frame)
+
     def __enter__(self) -> "EventHandler":
         return self
 
@@ -68,10 +279,10 @@ class EventHandler:
         self.callbacks.append(Callback.bp())
         return self
 
-    def do(self, func: str | Callable) -> "EventHandler":
+    def do(self, func: str | Callable, deferred: bool = False) -> "EventHandler":
         from .callback import Callback
 
-        self.callbacks.append(Callback.do(func))
+        self.callbacks.append(Callback.do(func, deferred=deferred))
         return self
 
     def goto(self, target: str | int) -> "EventHandler":
@@ -79,3 +290,27 @@ class EventHandler:
 
         self.callbacks.append(Callback.goto(target))
         return self
+
+    def capture(self, *exprs: str, size: int = 1024) -> "EventHandler":
+        from .callback import Callback
+
+        self.callbacks.append(Callback.capture(*exprs, size=size))
+        return self
+
+    def log(self, event_log: EventLog, *exprs: str) -> "EventHandler":
+        from .callback import Callback
+
+        self.callbacks.append(Callback.log(event_log, *exprs))
+        return self
+
+    def drain(self) -> list[tuple]:
+        """
+        Remove and return the records of all the capture callbacks.
+        """
+        from .callback import CaptureCallback
+
+        records = []
+        for cb in self.callbacks:
+            if isinstance(cb, CaptureCallback):
+                records.extend(cb.drain())
+        return records
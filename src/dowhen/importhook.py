@@ -0,0 +1,123 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/dowhen/blob/master/NOTICE
+
+from __future__ import annotations
+
+import importlib.abc
+import sys
+import warnings
+from importlib.machinery import ModuleSpec
+from types import ModuleType
+from typing import TYPE_CHECKING, Any
+
+from .instrumenter import Instrumenter
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .handler import EventHandler
+
+
+class ImportHook(importlib.abc.MetaPathFinder):
+    """
+    Post-import hook for the handlers whose trigger targets a module that
+    is not imported yet. The handlers are submitted right after the module
+    is executed. The hook is only in sys.meta_path while there are pending
+    handlers.
+    """
+
+    _initialized: bool = False
+    _instance: ImportHook
+
+    def __new__(cls, *args, **kwargs) -> ImportHook:
+        if not hasattr(cls, "_instance"):
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self) -> None:
+        if not self._initialized:
+            self.pending: dict[str, list[EventHandler]] = {}
+            self._initialized = True
+
+    def add(self, event_handler: "EventHandler") -> None:
+        module_name = event_handler.trigger.target_module
+        assert module_name is not None
+        self.pending.setdefault(module_name, []).append(event_handler)
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+        if module_name in sys.modules:
+            # The module was imported after the trigger was created
+            self.on_import(module_name)
+
+    def remove(self, event_handler: "EventHandler") -> None:
+        module_name = event_handler.trigger.target_module
+        assert module_name is not None
+        handlers = self.pending.get(module_name, [])
+        if event_handler in handlers:
+            handlers.remove(event_handler)
+            if not handlers:
+                del self.pending[module_name]
+        if not self.pending:
+            self.uninstall()
+
+    def uninstall(self) -> None:
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def clear(self) -> None:
+        self.pending.clear()
+        self.uninstall()
+
+    def find_spec(
+        self, fullname: str, path: Any = None, target: ModuleType | None = None
+    ) -> ModuleSpec | None:
+        if fullname not in self.pending:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is None or not hasattr(spec.loader, "exec_module"):
+            return None
+        spec.loader = _PostImportLoader(spec.loader, self)
+        return spec
+
+    def on_import(self, module_name: str) -> None:
+        handlers = self.pending.pop(module_name, [])
+        if not self.pending:
+            self.uninstall()
+        instrumenter = Instrumenter()
+        with instrumenter.batch():
+            for handler in handlers:
+                target = handler.trigger.target
+                try:
+                    handler.trigger.resolve()
+                except Exception as e:
+                    warnings.warn(
+                        f"dowhen could not instrument '{target}': {e}",
+                        RuntimeWarning,
+                    )
+                else:
+                    instrumenter.submit(handler)
+
+
+class _PostImportLoader(importlib.abc.Loader):
+    def __init__(self, loader: Any, hook: ImportHook):
+        self.loader = loader
+        self.hook = hook
+
+    def create_module(self, spec: ModuleSpec) -> ModuleType | None:
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module: ModuleType) -> None:
+        # Put the original loader back so the module is not aware of the hook
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+        self.loader.exec_module(module)
+        self.hook.on_import(module.__name__)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.loader, name)
@@ -3,10 +3,11 @@
 
 from __future__ import annotations
 
+import contextlib
 import sys
 from collections import defaultdict
 from types import CodeType, FrameType
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, Callable
 
 if TYPE_CHECKING:  # pragma: no cover
     from .handler import EventHandler
@@ -14,6 +15,23 @@ if TYPE_CHECKING:  # pragma: no cover
 E = sys.monitoring.events
 DISABLE = sys.monitoring.DISABLE
 
+EVENT_SETS = {
+    "line": E.LINE,
+    "start": E.PY_START,
+    "return": E.PY_RETURN,
+    "yield": E.PY_YIELD,
+    "resume": E.PY_RESUME,
+    "raise": E.RAISE,
+    "unwind": E.PY_UNWIND,
+    "handled": E.EXCEPTION_HANDLED,
+    "call": E.CALL,
+}
+
+# Events that can't be set locally, they are set globally while any code
+# object has a handler for them and the callbacks filter the code objects.
+# The callbacks can't return DISABLE for them either.
+GLOBAL_ONLY_EVENTS = ("raise", "unwind", "handled")
+
 
 class Instrumenter:
     _initialized: bool = False
@@ -27,6 +45,41 @@ class Instrumenter:
         if not self._initialized:
             self.tool_id = tool_id
             self.handlers: defaultdict[CodeType | None, dict] = defaultdict(dict)
+            # Flattened, immutable views of self.handlers for the callbacks.
+            # They are rebuilt per code object whenever self.handlers changes
+            # so the callbacks only need a single lookup. They are keyed by
+            # id() of the code object because hashing a code object is slow,
+            # the registered events keep the code objects alive.
+            # The global line handlers are gated by their identifiers, see
+            # EventHandler.call_global_line
+            self._line_dispatch: dict[
+                tuple[int, int], tuple[Callable[..., Any], ...]
+            ] = {}
+            self._line_dispatch_keys: dict[CodeType, set[int]] = {}
+            self._start_dispatch: dict[int, tuple[EventHandler, ...]] = {}
+            self._return_dispatch: dict[int, tuple[EventHandler, ...]] = {}
+            self._yield_dispatch: dict[int, tuple[EventHandler, ...]] = {}
+            self._resume_dispatch: dict[int, tuple[EventHandler, ...]] = {}
+            self._global_line_handlers: tuple[Callable[..., Any], ...] = ()
+            self._global_start_handlers: tuple[EventHandler, ...] = ()
+            self._global_return_handlers: tuple[EventHandler, ...] = ()
+            self._global_yield_handlers: tuple[EventHandler, ...] = ()
+            self._global_resume_handlers: tuple[EventHandler, ...] = ()
+            # Handlers of call events keyed by id() of the callee, per code
+            self._call_dispatch: dict[int, dict[int, tuple[EventHandler, ...]]] = {}
+            self._global_call_handlers: dict[int, tuple[EventHandler, ...]] = {}
+            self._exception_dispatch: dict[str, dict[int, tuple[EventHandler, ...]]] = {
+                event_type: {} for event_type in GLOBAL_ONLY_EVENTS
+            }
+            self._global_exception_handlers: dict[str, tuple[EventHandler, ...]] = {
+                event_type: () for event_type in GLOBAL_ONLY_EVENTS
+            }
+            self._global_events = E.NO_EVENTS
+            # Code objects whose events need to be applied, and whether
+            # restart_events() is needed, pending the end of the batch.
+            self._batch_depth = 0
+            self._pending_codes: set[CodeType | None] = set()
+            self._pending_restart = False
 
             sys.monitoring.use_tool_id(self.tool_id, "dowhen instrumenter")
             sys.monitoring.register_callback(self.tool_id, E.LINE, self.line_callback)
@@ -36,6 +89,20 @@ class Instrumenter:
             sys.monitoring.register_callback(
                 self.tool_id, E.PY_START, self.start_callback
             )
+            sys.monitoring.register_callback(
+                self.tool_id, E.PY_YIELD, self.yield_callback
+            )
+            sys.monitoring.register_callback(
+                self.tool_id, E.PY_RESUME, self.resume_callback
+            )
+            sys.monitoring.register_callback(self.tool_id, E.RAISE, self.raise_callback)
+            sys.monitoring.register_callback(
+                self.tool_id, E.PY_UNWIND, self.unwind_callback
+            )
+            sys.monitoring.register_callback(
+                self.tool_id, E.EXCEPTION_HANDLED, self.handled_callback
+            )
+            sys.monitoring.register_callback(self.tool_id, E.CALL, self.call_callback)
             self._initialized = True
 
     def clear_all(self) -> None:
@@ -45,25 +112,107 @@ class Instrumenter:
             else:
                 sys.monitoring.set_local_events(self.tool_id, code, E.NO_EVENTS)
         self.handlers.clear()
+        self._line_dispatch.clear()
+        self._line_dispatch_keys.clear()
+        self._start_dispatch.clear()
+        self._return_dispatch.clear()
+        self._yield_dispatch.clear()
+        self._resume_dispatch.clear()
+        self._global_line_handlers = ()
+        self._global_start_handlers = ()
+        self._global_return_handlers = ()
+        self._global_yield_handlers = ()
+        self._global_resume_handlers = ()
+        self._call_dispatch.clear()
+        self._global_call_handlers = {}
+        for event_type in GLOBAL_ONLY_EVENTS:
+            self._exception_dispatch[event_type].clear()
+            self._global_exception_handlers[event_type] = ()
+        self._global_events = E.NO_EVENTS
+        sys.monitoring.set_events(self.tool_id, E.NO_EVENTS)
+        self._pending_codes.clear()
+        self._pending_restart = False
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Defer applying the events of all the registrations and removals
+        in the block until the block exits. Each affected code object gets
+        a single set_local_events() call and events are restarted at most
+        once.
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._apply_events()
+
+    def _update_events(self, code: CodeType | None, restart: bool) -> None:
+        self._pending_codes.add(code)
+        self._pending_restart = self._pending_restart or restart
+        if self._batch_depth == 0:
+            self._apply_events()
+
+    def _apply_events(self) -> None:
+        codes = self._pending_codes
+        restart = self._pending_restart
+        self._pending_codes = set()
+        self._pending_restart = False
+
+        for code in codes:
+            if code is None:
+                continue
+            events = E.NO_EVENTS
+            for event_type in self.handlers.get(code, {}):
+                if event_type not in GLOBAL_ONLY_EVENTS:
+                    events |= EVENT_SETS[event_type]
+            sys.monitoring.set_local_events(self.tool_id, code, events)
+        self._rebuild_dispatch(codes)
+
+        global_events = E.NO_EVENTS
+        for event_type in self.handlers.get(None, {}):
+            global_events |= EVENT_SETS[event_type]
+        for event_type in GLOBAL_ONLY_EVENTS:
+            if self._exception_dispatch[event_type]:
+                global_events |= EVENT_SETS[event_type]
+        if global_events != self._global_events:
+            sys.monitoring.set_events(self.tool_id, global_events)
+            self._global_events = global_events
+
+        if restart:
+            sys.monitoring.restart_events()
 
     def submit(self, event_handler: "EventHandler") -> None:
         trigger = event_handler.trigger
-        for event in trigger.events:
-            code = event.code
-            if event.event_type == "line":
-                assert (
-                    isinstance(event.event_data, dict)
-                    and "line_number" in event.event_data
-                )
-                self.register_line_event(
-                    code,
-                    event.event_data["line_number"],
-                    event_handler,
-                )
-            elif event.event_type == "start":
-                self.register_start_event(code, event_handler)
-            elif event.event_type == "return":
-                self.register_return_event(code, event_handler)
+        with self.batch():
+            for event in trigger.events:
+                code = event.code
+                if event.event_type == "line":
+                    assert (
+                        isinstance(event.event_data, dict)
+                        and "line_number" in event.event_data
+                    )
+                    self.register_line_event(
+                        code,
+                        event.event_data["line_number"],
+                        event_handler,
+                    )
+                elif event.event_type == "start":
+                    self.register_start_event(code, event_handler)
+                elif event.event_type == "return":
+                    self.register_return_event(code, event_handler)
+                elif event.event_type == "yield":
+                    self.register_yield_event(code, event_handler)
+                elif event.event_type == "resume":
+                    self.register_resume_event(code, event_handler)
+                elif event.event_type == "call":
+                    self.register_call_event(
+                        code, event.event_data["callee"], event_handler
+                    )
+                else:
+                    self.register_exception_event(code, event.event_type, event_handler)
 
     def register_line_event(
         self, code: CodeType | None, line_number: int, event_handler: "EventHandler"
@@ -71,23 +220,12 @@ class Instrumenter:
         self.handlers[code].setdefault("line", {}).setdefault(line_number, []).append(
             event_handler
         )
-
-        if code is None:
-            events = sys.monitoring.get_events(self.tool_id)
-            sys.monitoring.set_events(self.tool_id, events | E.LINE)
-        else:
-            events = sys.monitoring.get_local_events(self.tool_id, code)
-            sys.monitoring.set_local_events(self.tool_id, code, events | E.LINE)
-        sys.monitoring.restart_events()
+        self._update_events(code, restart=True)
 
     def line_callback(self, code: CodeType, line_number: int):  # pragma: no cover
-        handlers = []
-        if None in self.handlers:
-            handlers.extend(self.handlers[None].get("line", {}).get(line_number, []))
-            handlers.extend(self.handlers[None].get("line", {}).get(None, []))
-        if code in self.handlers:
-            handlers.extend(self.handlers[code].get("line", {}).get(line_number, []))
-            handlers.extend(self.handlers[code].get("line", {}).get(None, []))
+        handlers = self._line_dispatch.get(
+            (id(code), line_number), self._global_line_handlers
+        )
         if handlers:
             return self._process_handlers(handlers, sys._getframe(1))
         return sys.monitoring.DISABLE
@@ -96,21 +234,10 @@ class Instrumenter:
         self, code: CodeType | None, event_handler: "EventHandler"
     ) -> None:
         self.handlers[code].setdefault("start", []).append(event_handler)
-
-        if code is None:
-            events = sys.monitoring.get_events(self.tool_id)
-            sys.monitoring.set_events(self.tool_id, events | E.PY_START)
-        else:
-            events = sys.monitoring.get_local_events(self.tool_id, code)
-            sys.monitoring.set_local_events(self.tool_id, code, events | E.PY_START)
-        sys.monitoring.restart_events()
+        self._update_events(code, restart=True)
 
     def start_callback(self, code: CodeType, offset: int):  # pragma: no cover
-        handlers = []
-        if None in self.handlers:
-            handlers.extend(self.handlers[None].get("start", []))
-        if code in self.handlers:
-            handlers.extend(self.handlers[code].get("start", []))
+        handlers = self._start_dispatch.get(id(code), self._global_start_handlers)
         if handlers:
             return self._process_handlers(handlers, sys._getframe(1))
         return sys.monitoring.DISABLE
@@ -119,78 +246,251 @@ class Instrumenter:
         self, code: CodeType | None, event_handler: "EventHandler"
     ) -> None:
         self.handlers[code].setdefault("return", []).append(event_handler)
-
-        if code is None:
-            events = sys.monitoring.get_events(self.tool_id)
-            sys.monitoring.set_events(self.tool_id, events | E.PY_RETURN)
-        else:
-            events = sys.monitoring.get_local_events(self.tool_id, code)
-            sys.monitoring.set_local_events(self.tool_id, code, events | E.PY_RETURN)
-        sys.monitoring.restart_events()
+        self._update_events(code, restart=True)
 
     def return_callback(
         self, code: CodeType, offset: int, retval: object
     ):  # pragma: no cover
-        handlers = []
-        if None in self.handlers:
-            handlers.extend(self.handlers[None].get("return", []))
-        if code in self.handlers:
-            handlers.extend(self.handlers[code].get("return", []))
+        handlers = self._return_dispatch.get(id(code), self._global_return_handlers)
+        if handlers:
+            return self._process_handlers(
+                handlers, sys._getframe(1), {"retval": retval}
+            )
+        return sys.monitoring.DISABLE
+
+    def register_yield_event(
+        self, code: CodeType | None, event_handler: "EventHandler"
+    ) -> None:
+        self.handlers[code].setdefault("yield", []).append(event_handler)
+        self._update_events(code, restart=True)
+
+    def yield_callback(
+        self, code: CodeType, offset: int, retval: object
+    ):  # pragma: no cover
+        handlers = self._yield_dispatch.get(id(code), self._global_yield_handlers)
+        if handlers:
+            return self._process_handlers(
+                handlers, sys._getframe(1), {"retval": retval}
+            )
+        return sys.monitoring.DISABLE
+
+    def register_resume_event(
+        self, code: CodeType | None, event_handler: "EventHandler"
+    ) -> None:
+        self.handlers[code].setdefault("resume", []).append(event_handler)
+        self._update_events(code, restart=True)
+
+    def resume_callback(self, code: CodeType, offset: int):  # pragma: no cover
+        # The value sent to the generator is not passed by sys.monitoring
+        handlers = self._resume_dispatch.get(id(code), self._global_resume_handlers)
+        if handlers:
+            return self._process_handlers(handlers, sys._getframe(1))
+        return sys.monitoring.DISABLE
+
+    def register_call_event(
+        self, code: CodeType | None, callee: object, event_handler: "EventHandler"
+    ) -> None:
+        # Keyed by id() because the callees are not necessarily hashable,
+        # the trigger keeps them alive
+        self.handlers[code].setdefault("call", {}).setdefault(id(callee), []).append(
+            event_handler
+        )
+        self._update_events(code, restart=True)
+
+    def call_callback(
+        self, code: CodeType, offset: int, callee: object, arg0: object
+    ):  # pragma: no cover
+        handlers = self._call_dispatch.get(id(code), self._global_call_handlers).get(
+            id(callee)
+        )
         if handlers:
-            return self._process_handlers(handlers, sys._getframe(1), retval=retval)
+            return self._process_handlers(
+                handlers, sys._getframe(1), {"callee": callee}
+            )
+        # The call site calls something else, it's disabled until the
+        # events are restarted
         return sys.monitoring.DISABLE
 
+    def register_exception_event(
+        self, code: CodeType | None, event_type: str, event_handler: "EventHandler"
+    ) -> None:
+        assert event_type in GLOBAL_ONLY_EVENTS
+        self.handlers[code].setdefault(event_type, []).append(event_handler)
+        self._update_events(code, restart=True)
+
+    def raise_callback(
+        self, code: CodeType, offset: int, exception: BaseException
+    ):  # pragma: no cover
+        self._process_exception_handlers("raise", code, exception)
+
+    def unwind_callback(
+        self, code: CodeType, offset: int, exception: BaseException
+    ):  # pragma: no cover
+        self._process_exception_handlers("unwind", code, exception)
+
+    def handled_callback(
+        self, code: CodeType, offset: int, exception: BaseException
+    ):  # pragma: no cover
+        self._process_exception_handlers("handled", code, exception)
+
+    def _process_exception_handlers(
+        self, event_type: str, code: CodeType, exception: BaseException
+    ) -> None:  # pragma: no cover
+        handlers = self._exception_dispatch[event_type].get(
+            id(code), self._global_exception_handlers[event_type]
+        )
+        if handlers:
+            # The event can't be disabled, the result is ignored
+            self._process_handlers(handlers, sys._getframe(2), {"exception": exception})
+
     def _process_handlers(
-        self, handlers: list["EventHandler"], frame: FrameType, **kwargs
+        self,
+        handlers: tuple[Callable[..., Any], ...],
+        frame: FrameType,
+        kwargs: dict | None = None,
     ):  # pragma: no cover
         disable = sys.monitoring.DISABLE
-        for handler in handlers:
-            disable = handler(frame, **kwargs) and disable
+        # Calling __call__ directly avoids the slot wrapper of calling an
+        # instance, and forwarding **kwargs is surprisingly costly so the
+        # event data is only passed when there is some
+        if kwargs:
+            for handler in handlers:
+                disable = handler.__call__(frame, **kwargs) and disable
+        else:
+            for handler in handlers:
+                disable = handler.__call__(frame) and disable
         return sys.monitoring.DISABLE if disable else None
 
     def restart_events(self) -> None:
         sys.monitoring.restart_events()
 
-    def remove_handler(self, event_handler: "EventHandler") -> None:
-        trigger = event_handler.trigger
-        for event in trigger.events:
-            code = event.code
-            if code not in self.handlers or event.event_type not in self.handlers[code]:
-                continue
-            if event.event_type == "line":
-                assert (
-                    isinstance(event.event_data, dict)
-                    and "line_number" in event.event_data
+    def _rebuild_dispatch(self, codes: set[CodeType | None]) -> None:
+        if None in codes:
+            global_handlers = self.handlers.get(None, {})
+            self._global_line_handlers = tuple(
+                handler.call_global_line
+                if handler.trigger.global_identifiers
+                else handler
+                for handler in global_handlers.get("line", {}).get(None, ())
+            )
+            self._global_start_handlers = tuple(global_handlers.get("start", ()))
+            self._global_return_handlers = tuple(global_handlers.get("return", ()))
+            self._global_yield_handlers = tuple(global_handlers.get("yield", ()))
+            self._global_resume_handlers = tuple(global_handlers.get("resume", ()))
+            self._global_call_handlers = {
+                callee_id: tuple(call_handlers)
+                for callee_id, call_handlers in global_handlers.get("call", {}).items()
+            }
+            for event_type in GLOBAL_ONLY_EVENTS:
+                self._global_exception_handlers[event_type] = tuple(
+                    global_handlers.get(event_type, ())
                 )
-                handlers = self.handlers[code]["line"].get(
-                    event.event_data["line_number"], []
+            # Every code specific entry includes the global handlers
+            codes = set(self.handlers)
+            codes.discard(None)
+
+        for code in codes:
+            assert code is not None
+            self._rebuild_code_dispatch(code)
+
+    def _rebuild_code_dispatch(self, code: CodeType) -> None:
+        # New entries are installed before stale ones are removed so a
+        # concurrent callback never observes a missing entry for a live event.
+        handlers = self.handlers.get(code, {})
+
+        line_handlers = handlers.get("line", {})
+        every_line = tuple(line_handlers.get(None, ()))
+        line_numbers = {line for line in line_handlers if line is not None}
+        if every_line:
+            line_numbers.update(
+                line for _, _, line in code.co_lines() if line is not None
+            )
+        for line_number in line_numbers:
+            self._line_dispatch[(id(code), line_number)] = (
+                self._global_line_handlers
+                + tuple(line_handlers.get(line_number, ()))
+                + every_line
+            )
+        for line_number in self._line_dispatch_keys.pop(code, set()) - line_numbers:
+            del self._line_dispatch[(id(code), line_number)]
+        if line_numbers:
+            self._line_dispatch_keys[code] = line_numbers
+
+        call_handlers = handlers.get("call", {})
+        if call_handlers:
+            callees = dict(self._global_call_handlers)
+            for callee_id, callee_handlers in call_handlers.items():
+                callees[callee_id] = callees.get(callee_id, ()) + tuple(callee_handlers)
+            self._call_dispatch[id(code)] = callees
+        else:
+            self._call_dispatch.pop(id(code), None)
+
+        for event_type, dispatch, global_handlers in (
+            ("start", self._start_dispatch, self._global_start_handlers),
+            ("return", self._return_dispatch, self._global_return_handlers),
+            ("yield", self._yield_dispatch, self._global_yield_handlers),
+            ("resume", self._resume_dispatch, self._global_resume_handlers),
+            *(
+                (
+                    event_type,
+                    self._exception_dispatch[event_type],
+                    self._global_exception_handlers[event_type],
                 )
+                for event_type in GLOBAL_ONLY_EVENTS
+            ),
+        ):
+            if handlers.get(event_type):
+                dispatch[id(code)] = global_handlers + tuple(handlers[event_type])
             else:
-                handlers = self.handlers[code][event.event_type]
+                dispatch.pop(id(code), None)
 
-            if event_handler in handlers:
-                handlers.remove(event_handler)
+    def get_handlers(self) -> list["EventHandler"]:
+        """
+        All the registered handlers, in the order of registration per code.
+        """
+        handlers: dict[EventHandler, None] = {}
+        for code_handlers in self.handlers.values():
+            for event_type, event_handlers in code_handlers.items():
+                if isinstance(event_handlers, dict):
+                    # Line and call handlers are keyed by line and callee
+                    for keyed_handlers in event_handlers.values():
+                        handlers.update(dict.fromkeys(keyed_handlers))
+                else:
+                    handlers.update(dict.fromkeys(event_handlers))
+        return list(handlers)
 
-                if event.event_type == "line" and not handlers:
+    def remove_handler(self, event_handler: "EventHandler") -> None:
+        trigger = event_handler.trigger
+        with self.batch():
+            for event in trigger.events:
+                code = event.code
+                if (
+                    code not in self.handlers
+                    or event.event_type not in self.handlers[code]
+                ):
+                    continue
+                key = None
+                if event.event_type == "line":
                     assert (
                         isinstance(event.event_data, dict)
                         and "line_number" in event.event_data
                     )
-                    del self.handlers[code]["line"][event.event_data["line_number"]]
-
-                if not self.handlers[code][event.event_type]:
-                    del self.handlers[code][event.event_type]
-                    removed_event = {
-                        "line": E.LINE,
-                        "start": E.PY_START,
-                        "return": E.PY_RETURN,
-                    }[event.event_type]
-
-                    if code is None:
-                        events = sys.monitoring.get_events(self.tool_id)
-                        sys.monitoring.set_events(self.tool_id, events & ~removed_event)
-                    else:
-                        events = sys.monitoring.get_local_events(self.tool_id, code)
-                        sys.monitoring.set_local_events(
-                            self.tool_id, code, events & ~removed_event
-                        )
+                    key = event.event_data["line_number"]
+                elif event.event_type == "call":
+                    key = id(event.event_data["callee"])
+
+                if event.event_type in ("line", "call"):
+                    handlers = self.handlers[code][event.event_type].get(key, [])
+                else:
+                    handlers = self.handlers[code][event.event_type]
+
+                if event_handler in handlers:
+                    handlers.remove(event_handler)
+
+                    if event.event_type in ("line", "call") and not handlers:
+                        del self.handlers[code][event.event_type][key]
+
+                    if not self.handlers[code][event.event_type]:
+                        del self.handlers[code][event.event_type]
+
+                    self._update_events(code, restart=False)
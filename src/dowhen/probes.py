@@ -0,0 +1,185 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/dowhen/blob/master/NOTICE
+
+from __future__ import annotations
+
+import atexit
+import importlib.util
+import json
+import os
+import sys
+from collections.abc import Mapping
+from typing import TYPE_CHECKING, Any
+
+from .callback import Callback
+from .importhook import ImportHook
+from .instrumenter import Instrumenter
+from .trigger import Trigger
+from .util import LineNumberCache, resolve_target
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .handler import EventHandler
+
+
+# Keys of a probe and their types, other than the callback
+PROBE_OPTIONS: dict[str, type | tuple[type, ...]] = {
+    "condition": str,
+    "source_hash": str,
+    "sample_every": int,
+    "sample_rate": (int, float),
+    "max_rate": (int, float),
+    "burst": (int, float),
+    "throttle_disable": bool,
+    "recursive": bool,
+    "once": bool,
+    "max_fires": int,
+}
+CALLBACK_KEYS = ("do", "call")
+
+
+def read_probe_spec(path: str | os.PathLike) -> dict[str, Any]:
+    """
+    Read a probe spec from a TOML file, or a JSON file for the other
+    extensions.
+    """
+    if os.fspath(path).endswith(".toml"):
+        import tomllib
+
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
+    if not isinstance(spec, dict):
+        raise ValueError(f"The probe spec must be an object, got {type(spec)}")
+    return spec
+
+
+def _find_module(module_name: str) -> bool:
+    if module_name in sys.modules:
+        return True
+    try:
+        return importlib.util.find_spec(module_name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def _parse_probe(probe: Any) -> tuple[Trigger, Callback]:
+    if not isinstance(probe, Mapping):
+        raise TypeError(f"A probe must be a table, got {type(probe)}")
+    unknown = set(probe) - {"target", "identifiers", "deferred", *CALLBACK_KEYS}
+    unknown -= set(PROBE_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown keys: {', '.join(sorted(unknown))}")
+
+    target = probe.get("target")
+    if not isinstance(target, str):
+        raise TypeError("target must be a string like 'package.module:function'.")
+    # The modules that are not imported yet are instrumented when they are,
+    # make sure that can happen at all
+    module_name = target.partition(":")[0]
+    if not _find_module(module_name):
+        raise ValueError(f"Could not find module '{module_name}'.")
+
+    identifiers = probe.get("identifiers", [])
+    if not isinstance(identifiers, list):
+        identifiers = [identifiers]
+    for identifier in identifiers:
+        if not isinstance(identifier, (int, str)) or isinstance(identifier, bool):
+            raise TypeError(
+                f"identifiers must be line numbers or strings, got {identifier!r}"
+            )
+
+    options: dict[str, Any] = {}
+    for key, option_type in PROBE_OPTIONS.items():
+        if key in probe:
+            value = probe[key]
+            if not isinstance(value, option_type) or (
+                isinstance(value, bool) and option_type is not bool
+            ):
+                raise TypeError(f"{key} has the wrong type: {value!r}")
+            options[key] = value
+
+    callback_keys = [key for key in CALLBACK_KEYS if key in probe]
+    if len(callback_keys) != 1:
+        raise ValueError("A probe needs exactly one of 'do' and 'call'.")
+    deferred = probe.get("deferred", False)
+    if not isinstance(deferred, bool):
+        raise TypeError(f"deferred must be a boolean, got {deferred!r}")
+    if "do" in probe:
+        if not isinstance(probe["do"], str):
+            raise TypeError(f"do must be a string of code, got {probe['do']!r}")
+        if deferred:
+            raise ValueError("deferred only works with 'call', not 'do'.")
+        callback = Callback.do(probe["do"], deferred=deferred)
+    else:
+        if not isinstance(probe["call"], str):
+            raise TypeError(f"call must be a target string, got {probe['call']!r}")
+        callback = Callback.do(resolve_target(probe["call"]), deferred=deferred)
+
+    trigger = Trigger.when(target, *identifiers, **options)
+    return trigger, callback
+
+
+def load_probes(
+    spec: str | os.PathLike | Mapping[str, Any],
+    line_cache: str | os.PathLike | None = None,
+) -> list["EventHandler"]:
+    """
+    Register the probes of a spec, a TOML or JSON file or its content,
+    with a "probes" list. All the probes are validated before any of them
+    is registered, and they are registered in a single batch.
+
+    With line_cache, the resolved line numbers are saved to the file and
+    reused in the next runs. If some targets are not imported yet, the cache
+    stays installed for them and is saved when the interpreter exits.
+    """
+    from .handler import EventHandler
+
+    if not isinstance(spec, Mapping):
+        spec = read_probe_spec(spec)
+    probes = spec.get("probes", [])
+    if not isinstance(probes, list):
+        raise TypeError(f"probes must be a list, got {type(probes)}")
+
+    cache = None
+    if line_cache is not None:
+        cache = LineNumberCache(line_cache)
+        cache.install()
+
+    try:
+        parsed = []
+        errors = []
+        for i, probe in enumerate(probes):
+            try:
+                parsed.append(_parse_probe(probe))
+            except (TypeError, ValueError) as e:
+                target = probe.get("target") if isinstance(probe, Mapping) else None
+                errors.append(f"probe {i} ({target}): {e}")
+        if errors:
+            raise ValueError("Invalid probes:\n" + "\n".join(errors))
+
+        handlers = []
+        with Instrumenter().batch():
+            for trigger, callback in parsed:
+                handler = EventHandler(trigger, callback)
+                handler.submit()
+                handlers.append(handler)
+    except BaseException:
+        if cache is not None:
+            cache.uninstall()
+            cache.save()
+        raise
+
+    if cache is not None:
+        pending = ImportHook().pending
+        if any(
+            handler in pending.get(handler.trigger.target_module or "", [])
+            for handler in handlers
+        ):
+            # The line numbers of these targets are found when their
+            # modules are imported
+            atexit.register(cache.save)
+        else:
+            cache.uninstall()
+            cache.save()
+    return handlers
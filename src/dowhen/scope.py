@@ -0,0 +1,36 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/dowhen/blob/master/NOTICE
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+from collections.abc import Iterator
+
+
+class Scope:
+    """
+    Handlers created with when(..., scope=scope) only fire while the scope
+    is activated in the current context, which follows asyncio tasks and
+    threads.
+    """
+
+    def __init__(self, name: str = "dowhen_scope"):
+        self.name = name
+        self.var: contextvars.ContextVar[bool] = contextvars.ContextVar(
+            name, default=False
+        )
+
+    def __repr__(self) -> str:
+        return f"<Scope {self.name}>"
+
+    @contextlib.contextmanager
+    def activate(self) -> Iterator[Scope]:
+        token = self.var.set(True)
+        try:
+            yield self
+        finally:
+            self.var.reset(token)
+
+    def is_active(self) -> bool:
+        return self.var.get()
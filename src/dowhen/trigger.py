@@ -5,27 +5,71 @@
 from __future__ import annotations
 
 import inspect
+import math
+import random
 import sys
-from collections.abc import Callable
+import threading
+import weakref
+from collections.abc import Callable, Iterable, Mapping
 from types import CodeType, FrameType, FunctionType, MethodType, ModuleType
-from typing import TYPE_CHECKING, Any, Literal
-
-from .types import IdentifierType
-from .util import call_in_frame, get_line_numbers, get_source_hash, getrealsourcelines
+from typing import TYPE_CHECKING, Any
+
+from .scope import Scope
+from .types import EventType, IdentifierType
+from .util import (
+    CallPlan,
+    compile_source,
+    find_code_line_numbers,
+    get_all_code_objects,
+    get_line_numbers,
+    get_thread_ident,
+    getrealsourcelines,
+    resolve_callable,
+    resolve_target,
+    verify_source_hashes,
+)
 
 if TYPE_CHECKING:  # pragma: no cover
     from .callback import Callback
+    from .eventlog import EventLog
     from .handler import EventHandler
 
 
 DISABLE = sys.monitoring.DISABLE
 
 
+# Identifiers of the events that are not lines, and their event types
+EVENT_IDENTIFIERS: dict[Any, EventType] = {
+    "<start>": "start",
+    "<return>": "return",
+    "<yield>": "yield",
+    "<resume>": "resume",
+    "<raise>": "raise",
+    "<unwind>": "unwind",
+    "<handled>": "handled",
+}
+EXCEPTION_IDENTIFIERS = ("<raise>", "<unwind>", "<handled>")
+
+
+def get_call_target(identifier: Any) -> str | None:
+    """
+    The callee name of a "<call:name>" identifier, None for the other
+    identifiers.
+    """
+    if (
+        isinstance(identifier, str)
+        and identifier.startswith("<call:")
+        and identifier.endswith(">")
+    ):
+        return identifier[6:-1]
+    return None
+
+
 class _Event:
     def __init__(
         self,
         code: CodeType | None,
-        event_type: Literal["line", "start", "return"],
+        event_type: EventType,
         event_data: dict | None,
     ):
         self.code = code
@@ -39,10 +83,69 @@ class Trigger:
         events: list[_Event],
         condition: str | Callable[..., bool] | None = None,
         is_global: bool = False,
+        sample_every: int | None = None,
+        sample_rate: float | None = None,
+        max_rate: float | None = None,
+        burst: float | None = None,
+        throttle_disable: bool = False,
+        target: str | None = None,
+        identifiers: tuple[IdentifierType | tuple[IdentifierType, ...], ...] = (),
+        source_hash: str | None = None,
+        recursive: bool = False,
+        threads: frozenset[int] | None = None,
+        thread_filter: Callable[[threading.Thread], bool] | None = None,
+        scope: Scope | None = None,
+        exception: type[BaseException] | tuple[type[BaseException], ...] | None = None,
+        max_fires: int | None = None,
     ):
         self.events = events
         self.condition = condition
+        self.condition_code = None
+        self.condition_plan = None
+        if isinstance(condition, str):
+            self.condition_code = compile_source(condition, "eval")
+        elif condition is not None:
+            self.condition_plan = CallPlan(condition)
+        self.needs_locals = self.condition_code is not None or (
+            self.condition_plan is not None and self.condition_plan.needs_locals
+        )
         self.is_global = is_global
+        # Identifiers of the global line events, the line events of a global
+        # trigger only fire on the lines that match them. The other events
+        # of a mixed trigger, like <start>, are not filtered.
+        self.global_identifiers: tuple[IdentifierType | tuple, ...] = ()
+        if is_global:
+            self.global_identifiers = tuple(
+                event.event_data["identifier"]
+                for event in events
+                if event.event_type == "line" and "identifier" in event.event_data
+            )
+        # Resolved line numbers of global identifiers keyed by id() of the
+        # code object, an empty set means the code object never matches.
+        # The entry is evicted when the code object is garbage collected.
+        self._global_line_numbers: dict[int, frozenset[int]] = {}
+        self._global_code_refs: dict[int, weakref.ref] = {}
+        self.sample_every = sample_every
+        self.sample_rate = sample_rate
+        self.max_rate = max_rate
+        self.burst = (
+            burst if burst is not None or max_rate is None else max(1, max_rate)
+        )
+        self.throttle_disable = throttle_disable
+        # "package.module:Qualified.name" of a module that is not imported
+        # yet, the events are resolved by the import hook when it is.
+        self.target = target
+        self.target_module = target.partition(":")[0] if target else None
+        self.identifiers = identifiers
+        self.source_hash = source_hash
+        self.recursive = recursive
+        # Idents of the threads the handlers are scoped to, None for all
+        self.threads = threads
+        self.thread_filter = thread_filter
+        self.scope = scope
+        self.exception = exception
+        # The handlers remove themselves after firing this many times
+        self.max_fires = max_fires
 
     @classmethod
     def _get_code_from_entity(
@@ -124,14 +227,26 @@ class Trigger:
     @classmethod
     def when(
         cls,
-        entity: CodeType | FunctionType | MethodType | ModuleType | type | None,
+        entity: CodeType | FunctionType | MethodType | ModuleType | type | str | None,
         *identifiers: IdentifierType | tuple[IdentifierType, ...],
         condition: str | Callable[..., bool | Any] | None = None,
         source_hash: str | None = None,
+        sample_every: int | None = None,
+        sample_rate: float | None = None,
+        max_rate: float | None = None,
+        burst: float | None = None,
+        throttle_disable: bool = False,
+        recursive: bool = False,
+        threads: Iterable[int | threading.Thread] | None = None,
+        thread_filter: Callable[[threading.Thread], bool] | None = None,
+        scope: Scope | None = None,
+        exception: type[BaseException] | tuple[type[BaseException], ...] | None = None,
+        once: bool = False,
+        max_fires: int | None = None,
     ):
         if isinstance(condition, str):
             try:
-                compile(condition, "<string>", "eval")
+                compile_source(condition, "eval")
             except SyntaxError:
                 raise ValueError(f"Invalid condition expression: {condition}")
         elif condition is not None and not callable(condition):
@@ -146,11 +261,164 @@ class Trigger:
                 )
             if entity is None:
                 raise ValueError("source_hash cannot be used with a None entity.")
-            if get_source_hash(entity) != source_hash:
+
+        if sample_every is not None and sample_rate is not None:
+            raise ValueError("sample_every and sample_rate cannot be used together.")
+        if sample_every is not None:
+            if not isinstance(sample_every, int) or isinstance(sample_every, bool):
+                raise TypeError(
+                    f"sample_every must be an integer, got {type(sample_every)}"
+                )
+            if sample_every < 1:
+                raise ValueError("sample_every must be a positive integer.")
+        if sample_rate is not None:
+            if not isinstance(sample_rate, (int, float)) or isinstance(
+                sample_rate, bool
+            ):
+                raise TypeError(
+                    f"sample_rate must be a number, got {type(sample_rate)}"
+                )
+            if not 0 < sample_rate <= 1:
+                raise ValueError("sample_rate must be in the range (0, 1].")
+
+        if max_rate is not None:
+            if not isinstance(max_rate, (int, float)) or isinstance(max_rate, bool):
+                raise TypeError(f"max_rate must be a number, got {type(max_rate)}")
+            if max_rate <= 0:
+                raise ValueError("max_rate must be positive.")
+        if burst is not None:
+            if max_rate is None:
+                raise ValueError("burst can only be used with max_rate.")
+            if not isinstance(burst, (int, float)) or isinstance(burst, bool):
+                raise TypeError(f"burst must be a number, got {type(burst)}")
+            if burst < 1:
+                raise ValueError("burst must be at least 1.")
+        if throttle_disable and max_rate is None:
+            raise ValueError("throttle_disable can only be used with max_rate.")
+
+        thread_idents = None
+        if threads is not None:
+            if isinstance(threads, (int, threading.Thread)):
+                raise TypeError(
+                    "threads must be an iterable of threads or thread idents."
+                )
+            thread_idents = frozenset(get_thread_ident(thread) for thread in threads)
+        if thread_filter is not None and not callable(thread_filter):
+            raise TypeError(
+                f"thread_filter must be callable, got {type(thread_filter)}"
+            )
+
+        if scope is not None and not isinstance(scope, Scope):
+            raise TypeError(f"scope must be a Scope, got {type(scope)}")
+
+        if exception is not None:
+            exception_types = (
+                exception if isinstance(exception, tuple) else (exception,)
+            )
+            if not all(
+                isinstance(exc, type) and issubclass(exc, BaseException)
+                for exc in exception_types
+            ):
+                raise TypeError(
+                    f"exception must be an exception type or a tuple of them, got {exception}"
+                )
+            if not identifiers or not all(
+                identifier in EXCEPTION_IDENTIFIERS for identifier in identifiers
+            ):
+                raise ValueError(
+                    "exception can only be used with <raise>, <unwind> and <handled>."
+                )
+
+        if once:
+            if max_fires is not None:
+                raise ValueError("once and max_fires cannot be used together.")
+            max_fires = 1
+        if max_fires is not None:
+            if not isinstance(max_fires, int) or isinstance(max_fires, bool):
+                raise TypeError(f"max_fires must be an integer, got {type(max_fires)}")
+            if max_fires < 1:
+                raise ValueError("max_fires must be a positive integer.")
+
+        for identifier in identifiers:
+            name = get_call_target(identifier)
+            if name is not None and not all(
+                part.isidentifier() for part in name.replace(":", ".").split(".")
+            ):
+                raise ValueError(f"Invalid call target: {name!r}")
+
+        if recursive and not (
+            isinstance(entity, str)
+            or inspect.ismodule(entity)
+            or inspect.isclass(entity)
+        ):
+            raise TypeError("recursive can only be used with a module or a class.")
+
+        if isinstance(entity, str):
+            if entity.partition(":")[0] not in sys.modules:
+                # Resolved by the import hook when the module is imported
+                return cls(
+                    [],
+                    condition=condition,
+                    sample_every=sample_every,
+                    sample_rate=sample_rate,
+                    max_rate=max_rate,
+                    burst=burst,
+                    throttle_disable=throttle_disable,
+                    target=entity,
+                    identifiers=identifiers,
+                    source_hash=source_hash,
+                    recursive=recursive,
+                    threads=thread_idents,
+                    thread_filter=thread_filter,
+                    scope=scope,
+                    exception=exception,
+                    max_fires=max_fires,
+                )
+            entity = resolve_target(entity)
+            if isinstance(entity, str):
+                raise TypeError(f"Unknown entity type: {type(entity)}")
+
+        cls._check_source_hash(entity, source_hash)
+        if recursive:
+            events = cls._get_recursive_events(entity, *identifiers)
+        else:
+            events = cls._get_events(entity, *identifiers)
+
+        return cls(
+            events,
+            condition=condition,
+            is_global=entity is None,
+            sample_every=sample_every,
+            sample_rate=sample_rate,
+            max_rate=max_rate,
+            burst=burst,
+            throttle_disable=throttle_disable,
+            threads=thread_idents,
+            thread_filter=thread_filter,
+            scope=scope,
+            exception=exception,
+            max_fires=max_fires,
+        )
+
+    @classmethod
+    def _check_source_hash(
+        cls,
+        entity: CodeType | FunctionType | MethodType | ModuleType | type | None,
+        source_hash: str | None,
+    ) -> None:
+        if source_hash is not None:
+            assert entity is not None
+            if verify_source_hashes([(entity, source_hash)]):
                 raise ValueError(
                     "The source hash does not match the entity's source code."
                 )
 
+    @classmethod
+    def _get_events(
+        cls,
+        entity: CodeType | FunctionType | MethodType | ModuleType | type | None,
+        *identifiers: IdentifierType | tuple[IdentifierType, ...],
+    ) -> list[_Event]:
         events = []
 
         code_objects = cls._get_code_from_entity(entity)
@@ -160,13 +428,22 @@ class Trigger:
                 events.append(_Event(code, "line", {"line_number": None}))
         else:
             identifiers = cls.unify_identifiers(entity, *identifiers)
+            # Resolve all the identifiers of a code object together so its
+            # line index is still cached when there are many code objects
+            resolved_line_numbers = {
+                (code, identifier): get_line_numbers(code, identifier)
+                for code in code_objects
+                if code is not None
+                for identifier in identifiers
+                if identifier not in EVENT_IDENTIFIERS
+                and get_call_target(identifier) is None
+            }
             for identifier in identifiers:
-                if identifier == "<start>":
+                if identifier in EVENT_IDENTIFIERS:
                     for code in code_objects:
-                        events.append(_Event(code, "start", None))
-                elif identifier == "<return>":
-                    for code in code_objects:
-                        events.append(_Event(code, "return", None))
+                        events.append(_Event(code, EVENT_IDENTIFIERS[identifier], None))
+                elif (name := get_call_target(identifier)) is not None:
+                    events.extend(cls._get_call_events(code_objects, name))
                 else:
                     for code in code_objects:
                         if code is None:
@@ -179,7 +456,7 @@ class Trigger:
                                 )
                             )
                         else:
-                            line_numbers = get_line_numbers(code, identifier)
+                            line_numbers = resolved_line_numbers[code, identifier]
                             for c, numbers in line_numbers.items():
                                 for number in numbers:
                                     events.append(
@@ -191,44 +468,209 @@ class Trigger:
                 "Could not set any event based on the entity and identifiers."
             )
 
-        return cls(events, condition=condition, is_global=entity is None)
+        return events
+
+    @classmethod
+    def _get_call_events(
+        cls, code_objects: list[CodeType] | list[None], name: str
+    ) -> list[_Event]:
+        callee = resolve_callable(name)
+        if not callable(callee):
+            raise TypeError(f"Call target '{name}' is not callable.")
+        return [_Event(code, "call", {"callee": callee}) for code in code_objects]
+
+    @classmethod
+    def _get_code_recursively(cls, entity: ModuleType | type) -> list[CodeType]:
+        """
+        Get the code objects of all the functions and methods in a module
+        or a class, including the imported submodules of a package, nested
+        classes and nested functions. Only the objects defined in the
+        package, or in the class, are included.
+        """
+        if inspect.ismodule(entity):
+            package = entity.__name__
+            qualname_prefix = ""
+        else:
+            package = entity.__module__
+            qualname_prefix = entity.__qualname__ + "."
+
+        def is_included(obj: Any) -> bool:
+            module = getattr(obj, "__module__", None)
+            return (
+                isinstance(module, str)
+                and (module == package or module.startswith(package + "."))
+                and getattr(obj, "__qualname__", "").startswith(qualname_prefix)
+            )
+
+        stack: list[Any] = [entity]
+        if inspect.ismodule(entity) and hasattr(entity, "__path__"):
+            stack.extend(
+                module
+                for name, module in list(sys.modules.items())
+                if name.startswith(package + ".") and inspect.ismodule(module)
+            )
+
+        # Keyed by id() because equal code objects can be in different files
+        code_objects: dict[int, CodeType] = {}
+        visited: set[int] = set()
+        while stack:
+            obj = stack.pop()
+            if id(obj) in visited:
+                continue
+            visited.add(id(obj))
+            for member in list(vars(obj).values()):
+                if isinstance(member, (staticmethod, classmethod, MethodType)):
+                    member = member.__func__
+                elif callable(member) and hasattr(member, "__wrapped__"):
+                    member = inspect.unwrap(member)
+                if isinstance(member, property):
+                    members = [member.fget, member.fset, member.fdel]
+                else:
+                    members = [member]
+                for member_obj in members:
+                    if inspect.isfunction(member_obj):
+                        func = inspect.unwrap(member_obj)
+                        if inspect.isfunction(func) and is_included(func):
+                            for code in get_all_code_objects(func.__code__):
+                                code_objects[id(code)] = code
+                    elif inspect.isclass(member_obj) and is_included(member_obj):
+                        stack.append(member_obj)
+
+        return list(code_objects.values())
+
+    @classmethod
+    def _get_recursive_events(
+        cls,
+        entity: CodeType | FunctionType | MethodType | ModuleType | type | None,
+        *identifiers: IdentifierType | tuple[IdentifierType, ...],
+    ) -> list[_Event]:
+        assert inspect.ismodule(entity) or inspect.isclass(entity)
+        events = []
+
+        code_objects = cls._get_code_recursively(entity)
+
+        if not identifiers:
+            for code in code_objects:
+                events.append(_Event(code, "line", {"line_number": None}))
+        else:
+            identifiers = cls.unify_identifiers(entity, *identifiers)
+            for identifier in identifiers:
+                if identifier in EVENT_IDENTIFIERS:
+                    for code in code_objects:
+                        events.append(_Event(code, EVENT_IDENTIFIERS[identifier], None))
+                elif (name := get_call_target(identifier)) is not None:
+                    events.extend(cls._get_call_events(code_objects, name))
+                else:
+                    # Each code object only takes its own lines, the nested
+                    # code objects are in code_objects as well
+                    for code in code_objects:
+                        for number in find_code_line_numbers(code, identifier):
+                            events.append(_Event(code, "line", {"line_number": number}))
+
+        if not events:
+            raise ValueError(
+                "Could not set any event based on the entity and identifiers."
+            )
+
+        return events
+
+    def resolve(self) -> None:
+        """
+        Resolve the events of a trigger created with a target of a module
+        that was not imported yet.
+        """
+        if self.target is None:
+            return
+        entity = resolve_target(self.target)
+        self._check_source_hash(entity, self.source_hash)
+        if self.recursive:
+            if not (inspect.ismodule(entity) or inspect.isclass(entity)):
+                raise TypeError("recursive can only be used with a module or a class.")
+            self.events = self._get_recursive_events(entity, *self.identifiers)
+        else:
+            self.events = self._get_events(entity, *self.identifiers)
+        self.target = None
 
     def bp(self) -> "EventHandler":
         from .callback import Callback
 
         return self._submit_callback(Callback.bp())
 
-    def do(self, func: str | Callable) -> "EventHandler":
+    def do(self, func: str | Callable, deferred: bool = False) -> "EventHandler":
         from .callback import Callback
 
-        return self._submit_callback(Callback.do(func))
+        return self._submit_callback(Callback.do(func, deferred=deferred))
 
     def goto(self, target: str | int) -> "EventHandler":
         from .callback import Callback
 
         return self._submit_callback(Callback.goto(target))
 
+    def capture(self, *exprs: str, size: int = 1024) -> "EventHandler":
+        from .callback import Callback
+
+        return self._submit_callback(Callback.capture(*exprs, size=size))
+
+    def log(self, event_log: EventLog, *exprs: str) -> "EventHandler":
+        from .callback import Callback
+
+        return self._submit_callback(Callback.log(event_log, *exprs))
+
     def has_event(self, frame: FrameType) -> bool | Any:
-        if self.is_global and self.events[0].event_type == "line":
-            identifier = self.events[0].event_data.get("identifier")
-            assert isinstance(identifier, (str, int, tuple))
-            line_numbers = get_line_numbers(frame.f_code, identifier).get(
-                frame.f_code, None
-            )
+        if self.global_identifiers:
+            code = frame.f_code
+            line_numbers = self._global_line_numbers.get(id(code))
             if line_numbers is None:
-                return False
-            elif frame.f_lineno not in line_numbers:
-                return False
+                line_numbers = self._resolve_global_line_numbers(code)
+            return frame.f_lineno in line_numbers
         return True
 
-    def should_fire(self, frame: FrameType) -> bool | Any:
+    def _resolve_global_line_numbers(self, code: CodeType) -> frozenset[int]:
+        line_numbers: set[int] = set()
+        for identifier in self.global_identifiers:
+            line_numbers.update(get_line_numbers(code, identifier).get(code, ()))
+
+        code_id = id(code)
+        cache = self._global_line_numbers
+        code_refs = self._global_code_refs
+
+        def evict(_):
+            cache.pop(code_id, None)
+            code_refs.pop(code_id, None)
+
+        cache[code_id] = frozenset(line_numbers)
+        code_refs[code_id] = weakref.ref(code, evict)
+        return cache[code_id]
+
+    def sample_interval(self) -> int:
+        """
+        Number of hits until the next sampled one, 0 if sampling is not used.
+        """
+        if self.sample_every is not None:
+            return self.sample_every
+        if self.sample_rate is not None:
+            if self.sample_rate >= 1:
+                return 1
+            # Geometric distribution, so only one random number is drawn
+            # per sampled hit instead of one per hit
+            return (
+                int(math.log(1.0 - random.random()) / math.log(1.0 - self.sample_rate))
+                + 1
+            )
+        return 0
+
+    def should_fire(
+        self, frame: FrameType, f_locals: Mapping[str, Any] | None = None
+    ) -> bool | Any:
         if self.condition is None:
             return True
         try:
-            if isinstance(self.condition, str):
-                return eval(self.condition, frame.f_globals, frame.f_locals)
-            elif callable(self.condition):
-                return call_in_frame(self.condition, frame)
+            if self.condition_code is not None:
+                if f_locals is None:
+                    f_locals = frame.f_locals
+                return eval(self.condition_code, frame.f_globals, f_locals)
+            elif self.condition_plan is not None:
+                return self.condition_plan(frame, f_locals)
         except Exception:
             return False
 
@@ -5,4 +5,16 @@
 import re
 from typing import Literal
 
-IdentifierType = int | str | re.Pattern | Literal["<start>", "<return>"] | None
+IdentifierType = (
+    int
+    | str
+    | re.Pattern
+    | Literal[
+        "<start>", "<return>", "<yield>", "<resume>", "<raise>", "<unwind>", "<handled>"
+    ]
+    | None
+)
+
+EventType = Literal[
+    "line", "start", "return", "yield", "resume", "raise", "unwind", "handled", "call"
+]
@@ -4,19 +4,219 @@
 
 from __future__ import annotations
 
+import ast
+import builtins
+import contextlib
 import functools
+import importlib
 import inspect
+import json
+import os
 import re
-from collections.abc import Callable
+import sys
+import threading
+import tokenize
+import warnings
+import weakref
+from collections import OrderedDict, namedtuple
+from collections.abc import Callable, Iterable, Mapping
 from types import CodeType, FrameType, FunctionType, MethodType, ModuleType
-from typing import Any
+from typing import Any, Literal
 
 from .types import IdentifierType
 
 
+class SourceFile:
+    """
+    Lines of a source file and the source blocks of the code objects in it,
+    so a file is read once no matter how many of its functions are
+    instrumented. It is stale once the mtime or the size of the file changes.
+    """
+
+    if sys.version_info < (3, 13):
+        # inspect.findsource() before 3.13 walks back from co_firstlineno to
+        # the definition, do the same so the blocks are identical
+        definition_pattern = re.compile(
+            r"^(\s*def\s)|(\s*async\s+def\s)|(.*(?<!\w)lambda(:|\s))|^(\s*@)"
+        )
+    else:
+        definition_pattern = None
+
+    def __init__(self, filename: str, stat: os.stat_result):
+        self.filename = filename
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        with tokenize.open(filename) as f:
+            self.lines = f.readlines()
+        # co_firstlineno -> (block lines, start line) like inspect.getsourcelines()
+        self.blocks: dict[int, tuple[list[str], int]] = {}
+        self._stripped_lines: list[str] | None = None
+        # Line numbers in the whole file that match a line identifier
+        self._matches: dict[str | re.Pattern, frozenset[int]] = {}
+        # Qualname of a class -> the first lines of its definitions
+        self._class_lines: dict[str, list[int]] | None = None
+        # (co_firstlineno, the first line of a class or 0 for the whole
+        # file, algorithm) -> hash
+        self.hashes: dict[tuple[int, str], str] = {}
+
+    def is_stale(self, stat: os.stat_result) -> bool:
+        return stat.st_mtime_ns != self.mtime or stat.st_size != self.size
+
+    def get_block(
+        self, first_line_number: int, is_class: bool = False
+    ) -> tuple[list[str], int]:
+        block = self.blocks.get(first_line_number)
+        if block is None:
+            lnum = first_line_number - 1
+            # The first line of a class is already the start of its block
+            if self.definition_pattern is not None and not is_class:
+                while lnum > 0:
+                    if lnum >= len(self.lines):
+                        raise OSError("lineno is out of bounds")
+                    if self.definition_pattern.match(self.lines[lnum]):
+                        break
+                    lnum -= 1
+            elif lnum >= len(self.lines):
+                raise OSError("lineno is out of bounds")
+            block = self.blocks[first_line_number] = (
+                inspect.getblock(self.lines[lnum:]),
+                lnum + 1,
+            )
+        return block
+
+    def get_class_line(self, cls: type) -> int | None:
+        """
+        The first line of the class definition, including the decorators,
+        like inspect.findsource() finds it.
+        """
+        first_line_number = vars(cls).get("__firstlineno__")
+        if first_line_number is not None:
+            return first_line_number
+
+        if self._class_lines is None:
+            try:
+                tree = ast.parse("".join(self.lines))
+            except (SyntaxError, ValueError):
+                tree = None
+            finder = _ClassLineFinder()
+            if tree is not None:
+                finder.visit(tree)
+            self._class_lines = finder.lines
+        candidates = self._class_lines.get(cls.__qualname__)
+        if not candidates:
+            return None
+        if len(candidates) > 1:
+            # Classes with the same qualname, pick the definition that
+            # contains the methods of the class
+            for value in vars(cls).values():
+                code = getattr(getattr(value, "__func__", value), "__code__", None)
+                if inspect.iscode(code) and code.co_filename == self.filename:
+                    preceding = [c for c in candidates if c <= code.co_firstlineno]
+                    if preceding:
+                        return preceding[-1]
+        return candidates[0]
+
+    @property
+    def stripped_lines(self) -> list[str]:
+        if self._stripped_lines is None:
+            self._stripped_lines = [line.strip() for line in self.lines]
+        return self._stripped_lines
+
+    def get_definition_line(self, first_line_number: int) -> int:
+        """
+        The line of the definition after the decorators, like
+        getrealsourcelines() does.
+        """
+        line_number = first_line_number
+        stripped_lines = self.stripped_lines
+        while line_number <= len(stripped_lines) and stripped_lines[
+            line_number - 1
+        ].startswith("@"):
+            line_number += 1
+        return line_number
+
+    def match(self, ident: str | re.Pattern) -> frozenset[int]:
+        line_numbers = self._matches.get(ident)
+        if line_numbers is None:
+            if isinstance(ident, str):
+                line_numbers = frozenset(
+                    i + 1
+                    for i, line in enumerate(self.stripped_lines)
+                    if line.startswith(ident)
+                )
+            else:
+                line_numbers = frozenset(
+                    i + 1
+                    for i, line in enumerate(self.stripped_lines)
+                    if ident.match(line)
+                )
+            self._matches[ident] = line_numbers
+        return line_numbers
+
+
+class _ClassLineFinder(ast.NodeVisitor):
+    # Same qualnames as inspect._ClassFinder, but collects all the classes
+    def __init__(self) -> None:
+        self.stack: list[str] = []
+        self.lines: dict[str, list[int]] = {}
+
+    def visit_FunctionDef(self, node: ast.FunctionDef | ast.AsyncFunctionDef) -> None:
+        self.stack.extend((node.name, "<locals>"))
+        self.generic_visit(node)
+        del self.stack[-2:]
+
+    visit_AsyncFunctionDef = visit_FunctionDef  # type: ignore[assignment]
+
+    def visit_ClassDef(self, node: ast.ClassDef) -> None:
+        self.stack.append(node.name)
+        line_number = (
+            node.decorator_list[0].lineno if node.decorator_list else node.lineno
+        )
+        self.lines.setdefault(".".join(self.stack), []).append(line_number)
+        self.generic_visit(node)
+        self.stack.pop()
+
+
+_source_files: dict[str, SourceFile] = {}
+
+
+def get_source_file(filename: str) -> SourceFile | None:
+    try:
+        stat = os.stat(filename)
+    except (OSError, ValueError):
+        return None
+    source_file = _source_files.get(filename)
+    if source_file is None or source_file.is_stale(stat):
+        try:
+            source_file = SourceFile(filename, stat)
+        except (OSError, SyntaxError, UnicodeDecodeError):
+            return None
+        _source_files[filename] = source_file
+    return source_file
+
+
+def getsourcelines(obj) -> tuple[list[str], int]:
+    """
+    inspect.getsourcelines() served from the per-file source cache for
+    functions, methods and code objects. The returned lines must not be
+    modified.
+    """
+    code = inspect.unwrap(obj)
+    if inspect.ismethod(code):
+        code = code.__func__
+    if inspect.isfunction(code):
+        code = code.__code__
+    if inspect.iscode(code):
+        source_file = get_source_file(code.co_filename)
+        if source_file is not None:
+            return source_file.get_block(code.co_firstlineno)
+    return inspect.getsourcelines(obj)
+
+
 def getrealsourcelines(obj) -> tuple[list[str], int]:
     try:
-        lines, start_line = inspect.getsourcelines(obj)
+        lines, start_line = getsourcelines(obj)
+        lines = list(lines)
         # We need to find the actual definition of the function/class
         # when it is decorated
         while lines[0].strip().startswith("@"):
@@ -30,70 +230,432 @@ def getrealsourcelines(obj) -> tuple[list[str], int]:
     return lines, start_line
 
 
-@functools.lru_cache(maxsize=256)
-def get_all_code_objects(code: CodeType) -> list[CodeType]:
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class WeakLRUCache:
     """
-    Recursively get all code objects from the given code object.
+    LRU cache for functions whose first argument is a code object or a
+    function. Entries are keyed by id() of the first argument and evicted
+    when it is garbage collected, so the cache never keeps dynamically
+    created code alive. Bound methods are anchored on their function.
+    The cached values must not reference the first argument.
     """
-    all_code_objects = []
-    stack = [code]
+
+    def __init__(self, func: Callable, maxsize: int | None):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self._maxsize = maxsize
+        self._cache: OrderedDict[tuple, Any] = OrderedDict()
+        # id() of the anchor -> (weak or strong reference, keys of the anchor)
+        self._anchors: dict[int, tuple[Any, set[tuple]]] = {}
+        # id() of the anchors that died, the weakref callbacks only record
+        # them so the cache is never mutated from inside a garbage collection
+        self._dead: list[int] = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self) -> int | None:
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize: int | None) -> None:
+        with self._lock:
+            self._maxsize = maxsize
+            self._trim()
+
+    def __call__(self, obj: Any, *args) -> Any:
+        anchor = obj.__func__ if type(obj) is MethodType else obj
+        key = (id(anchor), anchor is not obj, *args)
+        with self._lock:
+            if self._dead:
+                self._purge()
+            try:
+                value = self._cache[key]
+            except KeyError:
+                pass
+            else:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = self.func(obj, *args)
+
+        with self._lock:
+            self.misses += 1
+            if self._dead:
+                self._purge()
+            if key not in self._cache:
+                self._track(anchor, key)
+            self._cache[key] = value
+            self._trim()
+        return value
+
+    def _track(self, anchor: Any, key: tuple) -> None:
+        anchor_id = key[0]
+        if anchor_id not in self._anchors:
+            try:
+                ref: Any = weakref.ref(anchor, lambda _: self._dead.append(anchor_id))
+            except TypeError:
+                # Not weak referenceable, the entries are only evicted by LRU
+                ref = anchor
+            self._anchors[anchor_id] = (ref, set())
+        self._anchors[anchor_id][1].add(key)
+
+    def _purge(self) -> None:
+        while self._dead:
+            _, keys = self._anchors.pop(self._dead.pop(), (None, ()))
+            for key in keys:
+                del self._cache[key]
+
+    def _trim(self) -> None:
+        if self._maxsize is None:
+            return
+        while len(self._cache) > self._maxsize:
+            key, _ = self._cache.popitem(last=False)
+            _, keys = self._anchors[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self._anchors[key[0]]
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            self._purge()
+        return CacheInfo(self.hits, self.misses, self._maxsize, len(self._cache))
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._anchors.clear()
+            self._dead.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def weak_lru_cache(maxsize: int | None = 256) -> Callable[[Callable], WeakLRUCache]:
+    def decorator(func: Callable) -> WeakLRUCache:
+        return WeakLRUCache(func, maxsize)
+
+    return decorator
+
+
+@weak_lru_cache(maxsize=1024)
+def get_nested_code_objects(code: CodeType) -> tuple[CodeType, ...]:
+    """
+    Recursively get all code objects nested in the given code object.
+    """
+    nested_code_objects = []
+    stack = [const for const in code.co_consts if isinstance(const, CodeType)]
     while stack:
         current_code = stack.pop()
         assert isinstance(current_code, CodeType)
 
-        all_code_objects.append(current_code)
+        nested_code_objects.append(current_code)
         for const in current_code.co_consts:
             if isinstance(const, CodeType):
                 stack.append(const)
 
-    return all_code_objects
+    return tuple(nested_code_objects)
 
 
-@functools.lru_cache(maxsize=256)
-def get_line_numbers(
+def get_all_code_objects(code: CodeType) -> list[CodeType]:
+    """
+    Recursively get all code objects from the given code object.
+    """
+    return [code, *get_nested_code_objects(code)]
+
+
+class LineIndex:
+    """
+    Source lines and line table of a code object and all its nested code
+    objects, built once so identifiers are resolved without scanning the
+    line tables again.
+    """
+
+    def __init__(self, code: CodeType):
+        lines, self.start_line = getrealsourcelines(code)
+        self.stripped_lines = [line.strip() for line in lines]
+        # Line number -> positions in get_all_code_objects() of the code
+        # objects that have the line. Positions are used instead of the
+        # code objects so the index does not keep the code object alive.
+        self.line_codes: dict[int, list[int]] = {}
+        for i, sub_code in enumerate(get_all_code_objects(code)):
+            for line_number in {line for _, _, line in sub_code.co_lines()}:
+                if line_number is not None:
+                    self.line_codes.setdefault(line_number, []).append(i)
+
+    def match(self, ident: IdentifierType) -> set[int]:
+        if isinstance(ident, int):
+            return {ident}
+        elif isinstance(ident, str):
+            return {
+                self.start_line + i
+                for i, line in enumerate(self.stripped_lines)
+                if line.startswith(ident)
+            }
+        elif isinstance(ident, re.Pattern):
+            return {
+                self.start_line + i
+                for i, line in enumerate(self.stripped_lines)
+                if ident.match(line)
+            }
+        raise TypeError(f"Unknown identifier type: {type(ident)}")
+
+
+@weak_lru_cache(maxsize=1024)
+def get_line_index(code: CodeType) -> LineIndex:
+    return LineIndex(code)
+
+
+class LineNumberCache:
+    """
+    Resolved line numbers saved in a JSON file, so the next run doesn't
+    read and tokenize the sources again. Entries are keyed by the mtime
+    and the size of the source file, and by the Python version as the
+    line tables differ between versions. Only int and str identifiers are
+    cached.
+    """
+
+    installed: LineNumberCache | None = None
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = path
+        self.entries: dict[str, list] = {}
+        self.dirty = False
+        # filename -> (mtime_ns, size), None if the file doesn't exist
+        self._stats: dict[str, tuple[int, int] | None] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except (OSError, ValueError):
+            pass
+
+    def install(self) -> None:
+        LineNumberCache.installed = self
+
+    def uninstall(self) -> None:
+        if LineNumberCache.installed is self:
+            LineNumberCache.installed = None
+
+    def _get_stat(self, filename: str) -> tuple[int, int] | None:
+        if filename not in self._stats:
+            try:
+                stat = os.stat(filename)
+                self._stats[filename] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                self._stats[filename] = None
+        return self._stats[filename]
+
+    def _get_key(
+        self, code: CodeType, identifier: IdentifierType | tuple[IdentifierType, ...]
+    ) -> str | None:
+        idents = identifier if isinstance(identifier, tuple) else (identifier,)
+        if not all(
+            isinstance(ident, (int, str)) and not isinstance(ident, bool)
+            for ident in idents
+        ):
+            return None
+        stat = self._get_stat(code.co_filename)
+        if stat is None:
+            return None
+        return json.dumps(
+            [
+                code.co_filename,
+                *stat,
+                sys.implementation.cache_tag,
+                code.co_qualname,
+                code.co_firstlineno,
+                idents,
+            ]
+        )
+
+    def get(
+        self, code: CodeType, identifier: IdentifierType | tuple[IdentifierType, ...]
+    ) -> tuple[tuple[int, list[int]], ...] | None:
+        key = self._get_key(code, identifier)
+        if key is None or key not in self.entries:
+            return None
+        return tuple((i, list(numbers)) for i, numbers in self.entries[key])
+
+    def set(
+        self,
+        code: CodeType,
+        identifier: IdentifierType | tuple[IdentifierType, ...],
+        line_numbers: tuple[tuple[int, list[int]], ...],
+    ) -> None:
+        key = self._get_key(code, identifier)
+        if key is not None:
+            self.entries[key] = [[i, numbers] for i, numbers in line_numbers]
+            self.dirty = True
+
+    def save(self) -> None:
+        """
+        Write the entries to the file, dropping the stale entries of the
+        source files checked in this run.
+        """
+        if not self.dirty:
+            return
+        entries = {}
+        for key, value in self.entries.items():
+            filename, mtime, size, *_ = json.loads(key)
+            stat = self._stats.get(filename, (mtime, size))
+            if stat == (mtime, size):
+                entries[key] = value
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            warnings.warn(f"dowhen could not save the line cache: {e}", RuntimeWarning)
+        self.dirty = False
+
+
+@weak_lru_cache(maxsize=4096)
+def find_line_numbers(
     code: CodeType, identifier: IdentifierType | tuple[IdentifierType, ...]
-) -> dict[CodeType, list[int]]:
+) -> tuple[tuple[int, list[int]], ...]:
+    """
+    Resolve the identifier to (position in get_all_code_objects(), line
+    numbers) pairs, ordered by the position.
+    """
+    line_number_cache = LineNumberCache.installed
+    if line_number_cache is not None:
+        cached = line_number_cache.get(code, identifier)
+        if cached is not None:
+            return cached
+        result = _find_line_numbers(code, identifier)
+        line_number_cache.set(code, identifier, result)
+        return result
+    return _find_line_numbers(code, identifier)
+
+
+def _find_line_numbers(
+    code: CodeType, identifier: IdentifierType | tuple[IdentifierType, ...]
+) -> tuple[tuple[int, list[int]], ...]:
     if not isinstance(identifier, tuple):
         identifier = (identifier,)
 
-    line_numbers_ret: dict[CodeType, list[int]] = {}
-    line_numbers_sets = []
+    index = get_line_index(code)
 
-    lines, start_line = getrealsourcelines(code)
+    agreed_line_numbers: set[int] | None = None
+    for ident in identifier:
+        line_numbers_set = index.match(ident)
+        if agreed_line_numbers is None:
+            agreed_line_numbers = line_numbers_set
+        else:
+            agreed_line_numbers &= line_numbers_set
+        if not agreed_line_numbers:
+            return ()
+
+    line_numbers_ret: dict[int, list[int]] = {}
+    for line_number in sorted(agreed_line_numbers or ()):
+        for i in index.line_codes.get(line_number, ()):
+            line_numbers_ret.setdefault(i, []).append(line_number)
+
+    return tuple(sorted(line_numbers_ret.items()))
 
+
+def get_line_numbers(
+    code: CodeType, identifier: IdentifierType | tuple[IdentifierType, ...]
+) -> dict[CodeType, list[int]]:
+    line_numbers = find_line_numbers(code, identifier)
+    if not line_numbers:
+        return {}
+    all_code_objects = get_all_code_objects(code)
+    return {all_code_objects[i]: list(numbers) for i, numbers in line_numbers}
+
+
+def find_code_line_numbers(
+    code: CodeType, identifier: IdentifierType | tuple[IdentifierType, ...]
+) -> list[int]:
+    """
+    Line numbers of the code object itself, not its nested code objects,
+    that match the identifier. Line identifiers are matched against the
+    whole file once, so this is cheap for many code objects of a file.
+    """
+    source_file = get_source_file(code.co_filename)
+    if source_file is None:
+        return get_line_numbers(code, identifier).get(code, [])
+
+    if not isinstance(identifier, tuple):
+        identifier = (identifier,)
+
+    code_lines = {line for _, _, line in code.co_lines() if line is not None}
+    definition_line = source_file.get_definition_line(code.co_firstlineno)
     for ident in identifier:
         if isinstance(ident, int):
-            line_numbers_set = {ident}
+            code_lines.intersection_update((ident,))
+        elif isinstance(ident, (str, re.Pattern)):
+            code_lines = {
+                line
+                for line in code_lines.intersection(source_file.match(ident))
+                if line >= definition_line
+            }
         else:
-            if isinstance(ident, str) or isinstance(ident, re.Pattern):
-                line_numbers_set = set()
-                for i, line in enumerate(lines):
-                    line = line.strip()
-                    if (isinstance(ident, str) and line.startswith(ident)) or (
-                        isinstance(ident, re.Pattern) and ident.match(line)
-                    ):
-                        line_number = start_line + i
-                        line_numbers_set.add(line_number)
-            else:
-                raise TypeError(f"Unknown identifier type: {type(ident)}")
+            raise TypeError(f"Unknown identifier type: {type(ident)}")
+        if not code_lines:
+            return []
+    return sorted(code_lines)
 
-        if not line_numbers_set:
-            return {}
-        line_numbers_sets.append(line_numbers_set)
 
-    agreed_line_numbers = set.intersection(*line_numbers_sets)
-    for sub_code in get_all_code_objects(code):
-        for line_number in agreed_line_numbers:
-            if line_number in (line[2] for line in sub_code.co_lines()):
-                line_numbers_ret.setdefault(sub_code, []).append(line_number)
+@functools.lru_cache(maxsize=1024)
+def compile_source(source: str, mode: Literal["exec", "eval"]) -> CodeType:
+    """
+    Compile a callback or condition string once and share the code object
+    between all the handlers that use the same source.
+    """
+    return compile(source, "<string>", mode)
+
+
+class RingBuffer:
+    """
+    Fixed-size buffer that keeps the latest records. The slots are
+    allocated up front, so adding a record only stores a reference.
+    """
 
-    for line_numbers in line_numbers_ret.values():
-        line_numbers.sort()
+    def __init__(self, size: int):
+        self.size = size
+        self.slots: list[Any] = [None] * size
+        # Number of records added since the last drain
+        self.count = 0
 
-    return line_numbers_ret
+    def append(self, record: Any) -> None:
+        self.slots[self.count % self.size] = record
+        self.count += 1
 
+    @property
+    def overwritten(self) -> int:
+        """
+        Number of records lost because the buffer was full.
+        """
+        return max(0, self.count - self.size)
 
-@functools.lru_cache(maxsize=256)
+    def __len__(self) -> int:
+        return min(self.count, self.size)
+
+    def drain(self) -> list[Any]:
+        """
+        Remove and return the records, from the oldest to the latest.
+        """
+        count, size, slots = self.count, self.size, self.slots
+        if count <= size:
+            records = slots[:count]
+        else:
+            start = count % size
+            records = slots[start:] + slots[:start]
+        self.slots = [None] * size
+        self.count = 0
+        return records
+
+
+@weak_lru_cache(maxsize=1024)
 def get_func_args(func: Callable) -> list[str]:
     args = inspect.getfullargspec(inspect.unwrap(func)).args
     # For bound methods, skip the first argument since it's already bound
@@ -103,35 +665,292 @@ def get_func_args(func: Callable) -> list[str]:
         return args
 
 
-def call_in_frame(func: Callable, frame: FrameType, **kwargs) -> Any:
-    f_locals = frame.f_locals
-    args = []
-    for arg in get_func_args(func):
-        if arg == "_frame":
-            argval = frame
-        elif arg == "_retval":
-            if "retval" not in kwargs:
-                raise TypeError("You can only use '_retval' in <return> callbacks.")
-            argval = kwargs["retval"]
-        elif arg in f_locals:
-            argval = f_locals[arg]
-        else:
-            raise TypeError(f"Argument '{arg}' not found in frame locals.")
-        args.append(argval)
-    return func(*args)
+class CallPlan:
+    """
+    Precomputed binding of a callback or condition function's arguments.
+    Each argument is resolved once to where its value comes from, so
+    calling the function only walks the slots.
+    """
+
+    FRAME = 0
+    KWARG = 1
+    LOCAL = 2
+
+    # Special arguments that are passed by the instrumenter with the event
+    special_args = {
+        "_retval": (
+            "retval",
+            "You can only use '_retval' in <return> and <yield> callbacks.",
+        ),
+        "_exception": (
+            "exception",
+            "You can only use '_exception' in <raise>, <unwind> and <handled> callbacks.",
+        ),
+        "_callee": ("callee", "You can only use '_callee' in <call:...> callbacks."),
+    }
+
+    def __init__(self, func: Callable):
+        self.func = func
+        self.args = tuple(get_func_args(func))
+        self.slots: tuple[tuple[int, str], ...] = tuple(
+            (self.FRAME, arg)
+            if arg == "_frame"
+            else (self.KWARG, arg)
+            if arg in self.special_args
+            else (self.LOCAL, arg)
+            for arg in self.args
+        )
+        self.needs_locals = any(kind == self.LOCAL for kind, _ in self.slots)
+        self.uses_frame = any(kind == self.FRAME for kind, _ in self.slots)
+
+    def __call__(
+        self, frame: FrameType, f_locals: Mapping[str, Any] | None = None, **kwargs
+    ) -> Any:
+        if not self.slots:
+            return self.func()
+        return self.func(*self.bind(frame, f_locals, **kwargs))
+
+    def bind(
+        self, frame: FrameType, f_locals: Mapping[str, Any] | None = None, **kwargs
+    ) -> tuple:
+        """
+        The arguments of the function for the frame and the event data.
+        """
+        if f_locals is None and self.needs_locals:
+            f_locals = frame.f_locals
+        args = []
+        for kind, arg in self.slots:
+            if kind == self.LOCAL:
+                assert f_locals is not None
+                try:
+                    args.append(f_locals[arg])
+                except KeyError:
+                    raise TypeError(f"Argument '{arg}' not found in frame locals.")
+            elif kind == self.FRAME:
+                args.append(frame)
+            else:
+                key, error = self.special_args[arg]
+                if key not in kwargs:
+                    raise TypeError(error)
+                args.append(kwargs[key])
+        return tuple(args)
+
+
+def get_thread_ident(thread: int | threading.Thread | None = None) -> int:
+    """
+    Ident of a thread given as a Thread or an ident, the current thread if
+    it is None.
+    """
+    if thread is None:
+        return threading.get_ident()
+    if isinstance(thread, threading.Thread):
+        if thread.ident is None:
+            raise ValueError(f"Thread {thread.name} is not started.")
+        return thread.ident
+    if isinstance(thread, int) and not isinstance(thread, bool):
+        return thread
+    raise TypeError(f"Expected a thread or a thread ident, got {type(thread)}")
+
+
+def resolve_target(target: str) -> Any:
+    """
+    Resolve a "package.module:Qualified.name" target, the part after ":"
+    is optional.
+    """
+    module_name, _, qualname = target.partition(":")
+    try:
+        obj: Any = importlib.import_module(module_name)
+        for attr in qualname.split(".") if qualname else ():
+            obj = getattr(obj, attr)
+    except (ImportError, AttributeError) as e:
+        raise ValueError(f"Could not resolve target '{target}': {e}") from None
+    return obj
+
+
+def resolve_callable(name: str) -> Any:
+    """
+    Resolve a dotted name like "package.module.Class.method", or a
+    "package.module:Qualified.name" target. A name that doesn't start with
+    a module is looked up in builtins.
+    """
+    if ":" in name:
+        return resolve_target(name)
+    parts = name.split(".")
+    for i in range(len(parts), 0, -1):
+        try:
+            obj: Any = importlib.import_module(".".join(parts[:i]))
+        except ImportError:
+            continue
+        break
+    else:
+        obj, i = builtins, 0
+    try:
+        for attr in parts[i:]:
+            obj = getattr(obj, attr)
+    except AttributeError as e:
+        raise ValueError(f"Could not resolve '{name}': {e}") from None
+    return obj
 
 
-def get_source_hash(entity: CodeType | FunctionType | MethodType | ModuleType | type):
+HASH_ALGORITHMS = ("md5", "blake2b")
+
+
+def _hash_source(lines: list[str], algorithm: str) -> str:
     import hashlib
 
-    source = inspect.getsource(entity)
-    return hashlib.md5(source.encode("utf-8")).hexdigest()[-8:]
+    data = "".join(lines).encode("utf-8")
+    if algorithm == "md5":
+        return hashlib.md5(data).hexdigest()[-8:]
+    # The algorithm is a part of the hash, so it can be verified
+    return "blake2b:" + hashlib.blake2b(data, digest_size=4).hexdigest()
+
+
+def _get_source_hash(
+    entity: CodeType | FunctionType | MethodType | ModuleType | type,
+    algorithm: str,
+    source_file_getter: Callable[[str], SourceFile | None],
+) -> str:
+    source_file = None
+    key: int | None = None
+    is_class = False
+    if inspect.ismodule(entity):
+        filename = inspect.getsourcefile(entity)
+        if filename is not None:
+            source_file = source_file_getter(filename)
+            key = 0
+    elif inspect.isclass(entity):
+        filename = inspect.getsourcefile(entity)
+        if filename is not None:
+            source_file = source_file_getter(filename)
+            if source_file is not None:
+                key = source_file.get_class_line(entity)
+                is_class = True
+    else:
+        code: Any = entity if inspect.iscode(entity) else inspect.unwrap(entity)
+        if inspect.ismethod(code):
+            code = code.__func__
+        if inspect.isfunction(code):
+            code = code.__code__
+        if inspect.iscode(code):
+            source_file = source_file_getter(code.co_filename)
+            key = code.co_firstlineno
+
+    if source_file is None or key is None:
+        return _hash_source(getsourcelines(entity)[0], algorithm)
+
+    source_hash = source_file.hashes.get((key, algorithm))
+    if source_hash is None:
+        if key == 0:
+            lines = source_file.lines
+        else:
+            lines = source_file.get_block(key, is_class=is_class)[0]
+        source_hash = source_file.hashes[(key, algorithm)] = _hash_source(
+            lines, algorithm
+        )
+    return source_hash
+
+
+def get_source_hash(
+    entity: CodeType | FunctionType | MethodType | ModuleType | type,
+    algorithm: Literal["md5", "blake2b"] = "md5",
+) -> str:
+    """
+    Short hash of the source code of the entity. The hashes are cached
+    per source file until the file changes.
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm: {algorithm}")
+    return _get_source_hash(entity, algorithm, get_source_file)
+
+
+def _get_hash_algorithm(source_hash: str) -> str:
+    return "blake2b" if source_hash.startswith("blake2b:") else "md5"
+
+
+def verify_source_hashes(
+    pairs: Iterable[
+        tuple[CodeType | FunctionType | MethodType | ModuleType | type, str]
+    ],
+) -> list[CodeType | FunctionType | MethodType | ModuleType | type]:
+    """
+    Verify a list of (entity, source_hash) pairs and return the entities
+    whose source doesn't match. Each source file is checked and read at
+    most once for the whole list.
+    """
+    source_files: dict[str, SourceFile | None] = {}
+
+    def source_file_getter(filename: str) -> SourceFile | None:
+        if filename not in source_files:
+            source_files[filename] = get_source_file(filename)
+        return source_files[filename]
+
+    mismatches = []
+    for entity, source_hash in pairs:
+        algorithm = _get_hash_algorithm(source_hash)
+        if _get_source_hash(entity, algorithm, source_file_getter) != source_hash:
+            mismatches.append(entity)
+    return mismatches
+
+
+def batch() -> contextlib.AbstractContextManager:
+    from .instrumenter import Instrumenter
+
+    return Instrumenter().batch()
+
+
+def enable_stats() -> None:
+    from .handler import EventHandler
+
+    EventHandler.collect_stats = True
+
+
+def disable_stats() -> None:
+    from .handler import EventHandler
+
+    EventHandler.collect_stats = False
+
+
+def stats() -> dict[Any, dict[str, Any]]:
+    """
+    Statistics of all the registered handlers, collected while
+    enable_stats() is on.
+    """
+    from .instrumenter import Instrumenter
+
+    return {handler: handler.get_stats() for handler in Instrumenter().get_handlers()}
+
+
+def configure_deferred(
+    maxsize: int | None = None,
+    on_full: Literal["drop_newest", "drop_oldest"] | None = None,
+) -> None:
+    """
+    Configure the queue of the deferred callbacks.
+    """
+    from .deferred import DeferredWorker
+
+    DeferredWorker().configure(maxsize=maxsize, on_full=on_full)
+
+
+def flush_deferred(timeout: float | None = None) -> bool:
+    """
+    Wait until all the deferred callbacks are done. Return False if it
+    timed out.
+    """
+    from .deferred import DeferredWorker
+
+    return DeferredWorker().flush(timeout)
 
 
 def clear_all() -> None:
+    from .importhook import ImportHook
     from .instrumenter import Instrumenter
 
     Instrumenter().clear_all()
-    get_all_code_objects.cache_clear()
-    get_line_numbers.cache_clear()
+    ImportHook().clear()
+    _source_files.clear()
+    get_nested_code_objects.cache_clear()
+    get_line_index.cache_clear()
+    find_line_numbers.cache_clear()
     get_func_args.cache_clear()
+    compile_source.cache_clear()
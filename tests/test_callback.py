@@ -68,6 +68,15 @@ def test_callback_call():
     assert x == 1
 
 
+def test_callback_compiled_once():
+    callback1 = dowhen.do("x = 1")
+    callback2 = dowhen.do("x = 1")
+    assert callback1.code is callback2.code
+
+    with pytest.raises(ValueError):
+        dowhen.do("x =")
+
+
 def test_method_callback_call():
     class A:
         def change(self, x):
@@ -147,6 +156,35 @@ def test_callback_retval():
         callback(frame)
 
 
+def test_call_plan():
+    from dowhen.util import CallPlan
+
+    def cb(_frame, x, _retval):
+        return _frame, x, _retval
+
+    plan = CallPlan(cb)
+    assert plan.slots == (
+        (CallPlan.FRAME, "_frame"),
+        (CallPlan.LOCAL, "x"),
+        (CallPlan.KWARG, "_retval"),
+    )
+    assert plan.needs_locals
+    assert plan.uses_frame
+
+    frame = sys._getframe()
+    assert plan(frame, {"x": 1}, retval=2) == (frame, 1, 2)
+
+    with pytest.raises(TypeError):
+        plan(frame, {}, retval=2)
+
+    with pytest.raises(TypeError):
+        plan(frame, {"x": 1})
+
+    plan = CallPlan(lambda _retval: _retval)
+    assert not plan.needs_locals
+    assert not plan.uses_frame
+
+
 def test_callback_disable():
     def cb():
         return dowhen.DISABLE
@@ -173,16 +211,193 @@ def test_callback_invalid_type():
         return [1]
 
     with pytest.raises(TypeError):
-        dowhen.do(change).when(f, "return x")
-        f(0)
+        with dowhen.do(change).when(f, "return x"):
+            f(0)
 
     with pytest.raises(TypeError):
-        dowhen.do(change_wrong).when(f, "return x")
-        f(0)
+        with dowhen.do(change_wrong).when(f, "return x"):
+            f(0)
 
     with pytest.raises(TypeError):
-        dowhen.do(change_wrong_type).when(f, "return x")
-        f(0)
+        with dowhen.do(change_wrong_type).when(f, "return x"):
+            f(0)
+
+
+def test_deferred():
+    import threading
+
+    def f(x):
+        return x
+
+    calls = []
+
+    def cb(x, _retval):
+        calls.append((x, _retval, threading.current_thread().name))
+        return {"x": 100}
+
+    with dowhen.do(cb, deferred=True).when(f, "<return>"):
+        assert f(1) == 1
+        assert f(2) == 2
+        assert dowhen.flush_deferred(timeout=5)
+        assert calls == [(1, 1, "dowhen-deferred"), (2, 2, "dowhen-deferred")]
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(x):
+        started.set()
+        release.wait()
+        calls.append(x)
+
+    calls.clear()
+    worker = dowhen.deferred.DeferredWorker()
+    dropped = worker.dropped
+    for on_full, expected in (("drop_newest", [0, 1, 2]), ("drop_oldest", [0, 3, 4])):
+        dowhen.configure_deferred(maxsize=2, on_full=on_full)
+        with dowhen.do(block, deferred=True).when(f, "<start>"):
+            f(0)
+            started.wait()
+            for x in range(1, 5):
+                f(x)
+            release.set()
+            assert dowhen.flush_deferred(timeout=5)
+        assert calls == expected
+        calls.clear()
+        started.clear()
+        release.clear()
+    assert worker.dropped == dropped + 4
+    dowhen.configure_deferred(maxsize=65536, on_full="drop_newest")
+
+    def error(x):
+        raise ValueError(x)
+
+    with dowhen.do(error, deferred=True).when(f, "<start>"):
+        with pytest.warns(RuntimeWarning):
+            f(0)
+            assert dowhen.flush_deferred(timeout=5)
+
+    def cb_frame(_frame):
+        pass
+
+    with pytest.raises(ValueError):
+        dowhen.do(cb_frame, deferred=True)
+
+    with pytest.raises(TypeError):
+        dowhen.do("x = 1", deferred=True)
+
+    with pytest.raises(ValueError):
+        dowhen.configure_deferred(maxsize=0)
+
+    with pytest.raises(ValueError):
+        dowhen.configure_deferred(on_full="block")
+
+
+def test_capture():
+    def f(items):
+        x = len(items)
+        return x
+
+    with dowhen.when(f, "return x").capture("x", "items[-1] * 2", size=3) as handler:
+        for i in range(5):
+            f([0] * i + [i])
+        assert handler.drain() == [(3, 4), (4, 6), (5, 8)]
+        assert handler.drain() == []
+        f([1])
+        assert handler.drain() == [(1, 2)]
+
+    handler = dowhen.capture("x").when(f, "return x").capture("items", size=1)
+    f([1])
+    f([2])
+    assert handler.drain() == [(1,), (1,), ([2],)]
+    handler.remove()
+
+    from dowhen.util import RingBuffer
+
+    buffer = RingBuffer(2)
+    for i in range(3):
+        buffer.append(i)
+    assert len(buffer) == 2
+    assert buffer.overwritten == 1
+    assert buffer.drain() == [1, 2]
+    assert len(buffer) == 0
+
+    with pytest.raises(ValueError):
+        dowhen.capture()
+
+    with pytest.raises(ValueError):
+        dowhen.capture("x +")
+
+    with pytest.raises(TypeError):
+        dowhen.capture(1)
+
+    with pytest.raises(ValueError):
+        dowhen.capture("x", size=0)
+
+    with pytest.raises(TypeError):
+        dowhen.capture("x", size=1.5)
+
+
+def test_log(tmp_path):
+    import threading
+
+    def f(x, y):
+        z = y
+        return z
+
+    path = tmp_path / "events.log"
+    with dowhen.EventLog(path, size=4096) as event_log:
+        with dowhen.when(f, "return z").log(event_log, "x", "y", "z", "x > 1"):
+            f(1, 0.5)
+            f(2, None)
+        with dowhen.log(event_log).when(f, "<start>"):
+            f(3, 1)
+        assert event_log.dropped == 0
+
+    records = list(dowhen.read_event_log(path))
+    assert [record.values for record in records] == [
+        (1, 0.5, 0.5, False),
+        (2, None, None, True),
+        (),
+    ]
+    assert records[0].exprs == ("x", "y", "z", "x > 1")
+    assert records[0].qualname == f.__qualname__
+    assert records[0].filename == __file__
+    assert records[0].line_number == f.__code__.co_firstlineno + 2
+    assert records[0].thread_id == threading.get_ident()
+    assert records[0].probe_id != records[2].probe_id
+    assert records[0].timestamp_ns <= records[1].timestamp_ns
+
+    with dowhen.EventLog(path, size=64) as event_log:
+        with dowhen.when(f, "return z").log(event_log, "x"):
+            for i in range(10):
+                f(i, 1)
+        assert event_log.dropped > 0
+    assert 0 < len(list(dowhen.read_event_log(path))) < 10
+
+    with dowhen.EventLog(path, size=4096) as event_log:
+        with dowhen.when(f, "return z").log(event_log, "x"):
+            assert f(2**64, 1) == 1
+            assert event_log.dropped == 1
+            f(1, 1)
+        assert event_log.dropped == 1
+    assert [record.values for record in dowhen.read_event_log(path)] == [(1,)]
+
+    with dowhen.EventLog(path, size=4096) as event_log:
+        with dowhen.when(f, "return z").log(event_log, "str(x)"):
+            with pytest.raises(TypeError):
+                f(1, 1)
+        with pytest.raises(ValueError):
+            dowhen.log(event_log, repr("x" * 70000))
+
+    with pytest.raises(TypeError):
+        dowhen.log(str(path))
+
+    with pytest.raises(ValueError):
+        dowhen.EventLog(path, size=1)
+
+    (tmp_path / "other.log").write_bytes(b"not a log")
+    with pytest.raises(ValueError):
+        list(dowhen.read_event_log(tmp_path / "other.log"))
 
 
 def test_frame():
@@ -192,8 +407,8 @@ def test_frame():
     def cb(_frame):
         return {"x": _frame.f_locals["x"] + 1}
 
-    dowhen.do(cb).when(f, "return x")
-    assert f(0) == 1
+    with dowhen.do(cb).when(f, "return x"):
+        assert f(0) == 1
 
 
 def test_goto():
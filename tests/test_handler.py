@@ -3,10 +3,13 @@
 
 
 import sys
+import threading
 
 import pytest
 
 import dowhen
+from dowhen.handler import EventHandler
+from dowhen.instrumenter import Instrumenter
 
 from .util import do_pdb_test
 
@@ -71,6 +74,365 @@ def test_handler_disable():
     assert handler.disabled
 
 
+def test_rate_limit():
+    def f(x):
+        return x
+
+    with dowhen.when(f, "return x", max_rate=0.01, burst=2).do("x = 1"):
+        assert [f(0) for _ in range(4)] == [1, 1, 0, 0]
+
+    with dowhen.when(f, "return x", max_rate=0.01).do("x = 1"):
+        assert [f(0) for _ in range(3)] == [1, 0, 0]
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", burst=2)
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", throttle_disable=True)
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", max_rate=0)
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", max_rate=1, burst=0.5)
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "return x", max_rate="1")
+
+
+def test_throttle_disable(monkeypatch):
+    def f(x):
+        return x
+
+    monkeypatch.setattr(EventHandler, "min_throttle_disable_time", 0)
+
+    handler = dowhen.when(
+        f, "return x", max_rate=20, burst=1, throttle_disable=True
+    ).do("x = 1")
+    assert f(0) == 1
+    assert f(0) == 0
+    assert handler.disabled
+    assert handler.throttle_timer is not None
+    handler.throttle_timer.join()
+    assert not handler.disabled
+    assert f(0) == 1
+
+    assert f(0) == 0
+    timer = handler.throttle_timer
+    handler.remove()
+    assert handler.throttle_timer is None
+    assert not timer.is_alive() or timer.finished.is_set()
+
+
+def test_stats(monkeypatch):
+    def f(x):
+        return x
+
+    monkeypatch.setattr(EventHandler, "collect_stats", False)
+
+    handler = dowhen.when(f, "return x", condition="x > 0").do("x = 1")
+    f(0)
+    assert dowhen.stats()[handler]["total"]["events"] == 0
+
+    dowhen.enable_stats()
+    f(0)
+    f(2)
+    f(3)
+    dowhen.disable_stats()
+    f(4)
+
+    stats = dowhen.stats()
+    assert handler in stats
+    total = stats[handler]["total"]
+    assert total["events"] == 3
+    assert total["rejections"] == 0
+    assert total["condition_evaluations"] == 3
+    assert total["condition_passes"] == 2
+    assert total["fires"] == 2
+    assert total["condition_ns"] > 0
+    assert total["callback_ns"] > 0
+    locations = stats[handler]["locations"]
+    assert list(locations) == [(f.__code__, f.__code__.co_firstlineno + 1)]
+    handler.remove()
+
+    def g(x):
+        return x
+
+    dowhen.enable_stats()
+    handler = dowhen.when(None, "return x").do("x = 1")
+    assert g(0) == 1
+    dowhen.disable_stats()
+    total = dowhen.stats()[handler]["total"]
+    assert total["rejections"] > 0
+    assert total["fires"] == 1
+    handler.remove()
+
+
+def test_threads():
+    def f(x):
+        return x
+
+    def run_in_thread(func, *args):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(func(*args)))
+        thread.start()
+        thread.join()
+        return results[0]
+
+    with dowhen.when(f, "return x", threads=[threading.current_thread()]).do(
+        "x = 1"
+    ) as handler:
+        assert f(0) == 1
+        assert run_in_thread(f, 0) == 0
+        handler.remove_thread()
+        assert f(0) == 0
+        handler.add_thread(threading.get_ident())
+        assert f(0) == 1
+
+    with dowhen.when(f, "return x").do("x = 1") as handler:
+        with pytest.raises(ValueError):
+            handler.remove_thread()
+        handler.add_thread()
+        assert f(0) == 1
+        assert run_in_thread(f, 0) == 0
+
+    with dowhen.when(
+        f, "return x", thread_filter=lambda thread: thread.name == "worker"
+    ).do("x = 1"):
+        assert f(0) == 0
+        results = []
+        thread = threading.Thread(target=lambda: results.append(f(0)), name="worker")
+        thread.start()
+        thread.join()
+        assert results == [1]
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "return x", threads=threading.get_ident())
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "return x", threads=["main"])
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", threads=[threading.Thread(target=f)])
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "return x", thread_filter="worker")
+
+
+def test_scope():
+    import asyncio
+
+    def f(x):
+        return x
+
+    scope = dowhen.Scope("debug")
+
+    async def request(debug):
+        if debug:
+            with scope.activate():
+                await asyncio.sleep(0)
+                return f(0)
+        await asyncio.sleep(0)
+        return f(0)
+
+    async def main():
+        return await asyncio.gather(request(True), request(False), request(True))
+
+    with dowhen.when(f, "return x", scope=scope).do("x = 1"):
+        assert f(0) == 0
+        assert asyncio.run(main()) == [1, 0, 1]
+        with scope.activate():
+            assert scope.is_active()
+            assert f(0) == 1
+        assert not scope.is_active()
+        assert f(0) == 0
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "return x", scope="debug")
+
+
+def test_exception_events():
+    def g(x):
+        if x < 0:
+            raise ValueError(x)
+        if x == 0:
+            raise KeyError(x)
+        return x
+
+    def f(x):
+        try:
+            return g(x)
+        except KeyError:
+            return None
+
+    events = []
+
+    def record(event, _exception):
+        events.append((event, type(_exception)))
+
+    with (
+        dowhen.when(g, "<raise>").do(lambda _exception: record("raise", _exception)),
+        dowhen.when(g, "<unwind>", exception=ValueError).do(
+            lambda _exception: record("unwind", _exception)
+        ),
+        dowhen.when(f, "<handled>").do(
+            lambda _exception: record("handled", _exception)
+        ),
+    ):
+        assert f(1) == 1
+        assert events == []
+
+        assert f(0) is None
+        assert events == [("raise", KeyError), ("handled", KeyError)]
+
+        events.clear()
+        with pytest.raises(ValueError):
+            g(-1)
+        assert events == [("raise", ValueError), ("unwind", ValueError)]
+
+        events.clear()
+        # Exceptions outside of the instrumented functions are ignored
+        try:
+            raise KeyError(0)
+        except KeyError:
+            pass
+        assert events == []
+
+    events.clear()
+    with pytest.raises(ValueError):
+        g(-1)
+    assert f(0) is None
+    assert events == []
+
+    with dowhen.when(None, "<handled>", exception=KeyError).do(
+        lambda _exception: record("handled", _exception)
+    ):
+        assert f(0) is None
+        assert events == [("handled", KeyError)]
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "<start>", exception=ValueError)
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "<raise>", exception=1)
+
+
+def test_yield_resume_events():
+    import asyncio
+
+    def gen(n):
+        for i in range(n):
+            yield i
+        return n
+
+    events = []
+
+    def on_yield(_retval):
+        events.append(("yield", _retval))
+
+    def on_resume(i):
+        events.append(("resume", i))
+
+    with (
+        dowhen.when(gen, "<yield>").do(on_yield),
+        dowhen.when(gen, "<resume>").do(on_resume),
+    ):
+        g = gen(2)
+        assert next(g) == 0
+        assert g.send(None) == 1
+        with pytest.raises(StopIteration):
+            next(g)
+        assert events == [("yield", 0), ("resume", 0), ("yield", 1), ("resume", 1)]
+
+    async def request():
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return 1
+
+    events.clear()
+    with dowhen.when(request, "<yield>", "<resume>").do(
+        lambda: events.append("suspension")
+    ):
+        assert asyncio.run(request()) == 1
+        assert events == ["suspension"] * 4
+
+    events.clear()
+    assert list(gen(2)) == [0, 1]
+    assert events == []
+
+
+def test_call_events():
+    import json
+    import time
+
+    def f(x):
+        time.sleep(0)
+        json.dumps(x)
+        return len([x])
+
+    calls = []
+
+    def record(_callee, x):
+        calls.append((_callee, x))
+
+    with dowhen.when(f, "<call:json.dumps>", "<call:len>").do(record):
+        assert f(1) == 1
+        assert f(2) == 1
+        assert calls == [(json.dumps, 1), (len, 1), (json.dumps, 2), (len, 2)]
+
+    calls.clear()
+    with dowhen.when(None, "<call:time:sleep>", condition="x == 3").do(record):
+        f(3)
+        f(4)
+        assert calls == [(time.sleep, 3)]
+
+    calls.clear()
+    f(5)
+    assert calls == []
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "<call:json.not_exist>")
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "<call:json..dumps>")
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "<call:sys.version>")
+
+
+def test_max_fires():
+    def f(x):
+        return x
+
+    handler = dowhen.when(f, "return x", once=True).do("x = 1")
+    assert [f(0) for _ in range(3)] == [1, 0, 0]
+    assert handler.removed
+    assert handler not in Instrumenter().get_handlers()
+    assert sys.monitoring.get_local_events(4, f.__code__) == 0
+
+    handler = dowhen.when(f, "return x", condition="x > 0", max_fires=2).do("x = 0")
+    assert [f(x) for x in (0, 1, 0, 2, 3)] == [0, 0, 0, 0, 3]
+    assert handler.removed
+    assert sys.monitoring.get_local_events(4, f.__code__) == 0
+
+    # Other handlers on the same code keep the events
+    with dowhen.when(f, "return x").do("x = 2"):
+        handler = dowhen.when(f, "<start>", once=True).do("x = 1")
+        assert [f(0) for _ in range(2)] == [2, 2]
+        assert handler.removed
+        assert sys.monitoring.get_local_events(4, f.__code__) != 0
+    assert sys.monitoring.get_local_events(4, f.__code__) == 0
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", once=True, max_fires=2)
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", max_fires=0)
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "return x", max_fires=1.5)
+
+
 def test_remove():
     def f(x):
         return x
@@ -97,6 +459,29 @@ def test_with():
     assert f(0) == 0
 
 
+def test_chain_writeback():
+    def f(x, y):
+        return x + y
+
+    def add_one(x):
+        return {"x": x + 1}
+
+    def check(x, y):
+        assert y == 10
+        return x >= 0
+
+    handler = (
+        dowhen.when(f, "return x + y", condition=check)
+        .do("x += 1")
+        .do(add_one)
+        .do("x *= 2")
+        .do(add_one)
+    )
+    assert f(0, 10) == 15
+    assert f(-1, 10) == 9
+    handler.remove()
+
+
 def test_chain():
     def f(x):
         x += 1
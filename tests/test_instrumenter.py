@@ -142,3 +142,88 @@ def test_disable_from_condition():
     with disable_coverage():
         f(0)
     assert_instrumented_line_count(f, 0)
+
+
+def test_dispatch_table():
+    def f(x):
+        x += 1
+        return x
+
+    instrumenter = Instrumenter()
+    line_number = f.__code__.co_firstlineno + 2
+
+    handler_line = dowhen.do("x = 1").when(f, "return x")
+    handler_every_line = dowhen.do("x += 1").when(f)
+    handler_global = dowhen.do("pass").when(None, "return x")
+    handler_start = dowhen.do("x = 1").when(f, "<start>")
+
+    assert instrumenter._line_dispatch[(id(f.__code__), line_number)] == (
+        handler_global,
+        handler_line,
+        handler_every_line,
+    )
+    assert instrumenter._line_dispatch[(id(f.__code__), line_number - 1)] == (
+        handler_global,
+        handler_every_line,
+    )
+    assert instrumenter._start_dispatch[id(f.__code__)] == (handler_start,)
+    assert f(0) == 2
+
+    handler_line.remove()
+    handler_every_line.remove()
+    assert (id(f.__code__), line_number) not in instrumenter._line_dispatch
+    assert (id(f.__code__), line_number - 1) not in instrumenter._line_dispatch
+
+    handler_global.remove()
+    handler_start.remove()
+    assert instrumenter._global_line_handlers == ()
+    assert id(f.__code__) not in instrumenter._start_dispatch
+
+
+def test_batch(monkeypatch):
+    def f(x):
+        x += 1
+        return x
+
+    def g(x):
+        return x
+
+    restart_count = 0
+    restart_events = sys.monitoring.restart_events
+
+    def counted_restart_events():
+        nonlocal restart_count
+        restart_count += 1
+        restart_events()
+
+    monkeypatch.setattr(sys.monitoring, "restart_events", counted_restart_events)
+
+    with dowhen.batch():
+        handler_f = dowhen.do("x = 1").when(f, "x += 1", "return x", "<start>")
+        handler_g = dowhen.do("x = 1").when(g, "return x")
+        assert restart_count == 0
+        assert (
+            sys.monitoring.get_local_events(Instrumenter().tool_id, f.__code__)
+            == E.NO_EVENTS
+        )
+
+    assert restart_count == 1
+    assert (
+        sys.monitoring.get_local_events(Instrumenter().tool_id, f.__code__)
+        == E.LINE | E.PY_START
+    )
+    assert f(0) == 1
+    assert g(0) == 1
+
+    with dowhen.batch():
+        handler_f.remove()
+        handler_g.remove()
+        assert f(0) == 1
+
+    assert restart_count == 1
+    assert (
+        sys.monitoring.get_local_events(Instrumenter().tool_id, f.__code__)
+        == E.NO_EVENTS
+    )
+    assert f(0) == 1
+    assert g(0) == 0
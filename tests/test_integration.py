@@ -80,8 +80,182 @@ def test_signature():
         (handler.goto, dowhen.goto),
         (trigger.bp, dowhen.bp),
         (handler.bp, dowhen.bp),
+        (trigger.capture, dowhen.capture),
+        (handler.capture, dowhen.capture),
+        (trigger.log, dowhen.log),
+        (handler.log, dowhen.log),
     ]
     for func1, func2 in signature_pairs:
         assert (
             inspect.signature(func1).parameters == inspect.signature(func2).parameters
         )
+
+
+def test_load_probes(tmp_path):
+    import sys
+
+    from dowhen.probes import load_probes
+    from dowhen.util import LineNumberCache
+
+    spec = {
+        "probes": [
+            {
+                "target": f"{__name__}:func_test",
+                "identifiers": ["return x"],
+                "condition": "x > 0",
+                "do": "x = 10",
+            },
+            {
+                "target": f"{__name__}:func_test",
+                "identifiers": "y = y + 1",
+                "sample_every": 2,
+                "call": f"{__name__}:change_y",
+            },
+        ]
+    }
+    handlers = load_probes(spec)
+    assert func_test(0, 0) == (10, 1)
+    assert func_test(-1, 0) == (0, 6)
+    for handler in handlers:
+        handler.remove()
+
+    spec_path = tmp_path / "spec.toml"
+    spec_path.write_text(
+        f"""
+        [[probes]]
+        target = "{__name__}:func_test"
+        identifiers = ["return x", "<start>"]
+        do = "x += 1"
+        """
+    )
+    cache_path = tmp_path / "cache" / "lines.json"
+    # The lines of func_test might be resolved in this process already
+    dowhen.clear_all()
+    for _ in range(2):
+        handlers = load_probes(spec_path, line_cache=cache_path)
+        assert func_test(0, 0) == (3, 1)
+        for handler in handlers:
+            handler.remove()
+    assert cache_path.exists()
+
+    json_path = tmp_path / "spec.json"
+    json_path.write_text('{"probes": [{"target": "json:dumps", "do": "pass"}]}')
+    for handler in load_probes(json_path):
+        handler.remove()
+
+    # The cache stays installed for the targets that are not imported yet
+    (tmp_path / "lazy_probe_module.py").write_text("def f(x):\n    return x\n")
+    lazy_cache_path = tmp_path / "lazy.json"
+    sys.path.insert(0, str(tmp_path))
+    try:
+        handlers = load_probes(
+            {
+                "probes": [
+                    {
+                        "target": "lazy_probe_module:f",
+                        "identifiers": "return x",
+                        "do": "x = 1",
+                    }
+                ]
+            },
+            line_cache=lazy_cache_path,
+        )
+        cache = LineNumberCache.installed
+        assert cache is not None
+        import lazy_probe_module
+
+        assert lazy_probe_module.f(0) == 1
+        cache.uninstall()
+        cache.save()
+        assert "lazy_probe_module.py" in lazy_cache_path.read_text()
+        for handler in handlers:
+            handler.remove()
+    finally:
+        sys.path.remove(str(tmp_path))
+        sys.modules.pop("lazy_probe_module", None)
+
+    # Nothing is registered if any probe is invalid
+    bad_probes = [
+        {"target": f"{__name__}:func_test", "do": "x = 10"},
+        {"target": f"{__name__}:func_test", "do": "x = 1", "call": "json:dumps"},
+        {"target": f"{__name__}:func_test", "do": "x = 1", "unknown": 1},
+        {"target": f"{__name__}:func_test", "do": "x = 1", "sample_every": "1"},
+        {"target": f"{__name__}:func_test", "identifiers": "not exist", "do": "x = 1"},
+        {"target": f"{__name__}:func_test", "identifiers": [1.5], "do": "x = 1"},
+        {"target": 1, "do": "x = 1"},
+        {"target": "dowhen_not_exist:f", "do": "x = 1"},
+        {"target": f"{__name__}:func_test", "do": "x = 1", "deferred": True},
+        "probe",
+    ]
+    with pytest.raises(ValueError) as exc_info:
+        load_probes({"probes": bad_probes})
+    assert str(exc_info.value).count("\nprobe ") == len(bad_probes) - 1
+    assert func_test(0, 0) == (1, 1)
+
+
+def change_y(y):
+    return {"y": y + 5}
+
+
+def test_line_number_cache(tmp_path):
+    from dowhen.util import LineNumberCache, find_line_numbers
+
+    source = tmp_path / "cached_module.py"
+    source.write_text("def f(x):\n    x += 1\n    return x\n")
+    namespace: dict = {}
+    exec(compile(source.read_text(), str(source), "exec"), namespace)
+    code = namespace["f"].__code__
+
+    cache_path = tmp_path / "lines.json"
+    cache = LineNumberCache(cache_path)
+    cache.install()
+    try:
+        assert find_line_numbers(code, "return x") == ((0, [3]),)
+    finally:
+        cache.uninstall()
+    cache.save()
+
+    cache = LineNumberCache(cache_path)
+    assert cache.get(code, "return x") == ((0, [3]),)
+    assert cache.get(code, "x += 1") is None
+
+    # Stale once the source file changes
+    source.write_text("def f(x):\n    return x\n")
+    assert LineNumberCache(cache_path).get(code, "return x") is None
+
+
+def test_main(tmp_path):
+    import os
+    import subprocess
+    import sys
+
+    # dowhen might not be installed, only on sys.path
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(dowhen.__file__)), env.get("PYTHONPATH", "")]
+    )
+    (tmp_path / "target_module.py").write_text("def f(x):\n    return x\n")
+    (tmp_path / "run.py").write_text(
+        "import sys\nfrom target_module import f\nprint(f(0), sys.argv[1:])\n"
+    )
+    (tmp_path / "spec.toml").write_text(
+        '[[probes]]\ntarget = "target_module:f"\nidentifiers = "return x"\n'
+        'do = "x = 42"\n'
+    )
+    cache = str(tmp_path / "lines.json")
+    for args in (
+        ["run.py", "--flag"],
+        ["-m", "run", "--flag"],
+    ):
+        result = subprocess.run(
+            [sys.executable, "-m", "dowhen", "--probes", "spec.toml"]
+            + ["--line-cache", cache]
+            + args,
+            cwd=tmp_path,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.strip() == "42 ['--flag']"
+        assert "target_module.py" in (tmp_path / "lines.json").read_text()
@@ -3,6 +3,9 @@
 
 
 import functools
+import gc
+import importlib.machinery
+import random
 import re
 import sys
 
@@ -298,6 +301,10 @@ def test_condition():
 
     dowhen.clear_all()
 
+    trigger1 = dowhen.when(f, "return x", condition="x == 0")
+    trigger2 = dowhen.when(f, "return x", condition="x == 0")
+    assert trigger1.condition_code is trigger2.condition_code
+
     with pytest.raises(ValueError):
         dowhen.when(f, "return x", condition="x ==")
 
@@ -305,6 +312,50 @@ def test_condition():
         dowhen.when(f, "return x", condition=1.5)
 
 
+def test_sampling():
+    def f(x):
+        return x
+
+    with dowhen.when(f, "return x", sample_every=3).do("x = 1"):
+        results = [f(0) for _ in range(7)]
+    assert results == [0, 0, 1, 0, 0, 1, 0]
+
+    with dowhen.when(f, "return x", sample_rate=1).do("x = 1"):
+        assert [f(0) for _ in range(3)] == [1, 1, 1]
+
+    random.seed(42)
+    with dowhen.when(f, "return x", sample_rate=0.1).do("x = 1"):
+        hits = sum(f(0) for _ in range(1000))
+    assert 50 < hits < 200
+
+    counter = 0
+
+    def cond():
+        nonlocal counter
+        counter += 1
+        return True
+
+    with dowhen.when(f, "return x", condition=cond, sample_every=10).do("x = 1"):
+        for _ in range(100):
+            f(0)
+    assert counter == 10
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", sample_every=2, sample_rate=0.5)
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", sample_every=0)
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "return x", sample_every=1.5)
+
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", sample_rate=0)
+
+    with pytest.raises(TypeError):
+        dowhen.when(f, "return x", sample_rate="0.5")
+
+
 def test_source_hash():
     def f(x):
         return x
@@ -319,6 +370,73 @@ def test_source_hash():
     with pytest.raises(TypeError):
         dowhen.when(f, "return x", source_hash=123)
 
+    blake2b_hash = dowhen.get_source_hash(f, algorithm="blake2b")
+    assert blake2b_hash.startswith("blake2b:") and blake2b_hash != source_hash
+    dowhen.when(f, "return x", source_hash=blake2b_hash)
+    with pytest.raises(ValueError):
+        dowhen.when(f, "return x", source_hash=blake2b_hash[:-1])
+
+    with pytest.raises(ValueError):
+        dowhen.get_source_hash(f, algorithm="sha1")
+
+
+def test_verify_source_hashes():
+    import hashlib
+    import inspect
+
+    def f(x):
+        return x
+
+    class A:
+        def g(self):
+            return 1
+
+    entities = [f, A, A.g, A().g, f.__code__, sys.modules[__name__]]
+    for entity in entities:
+        expected = hashlib.md5(inspect.getsource(entity).encode("utf-8")).hexdigest()
+        assert dowhen.get_source_hash(entity) == expected[-8:]
+
+    pairs = [(entity, dowhen.get_source_hash(entity)) for entity in entities]
+    pairs += [
+        (entity, dowhen.get_source_hash(entity, algorithm="blake2b"))
+        for entity in entities
+    ]
+    assert dowhen.verify_source_hashes(pairs) == []
+    assert dowhen.verify_source_hashes([(f, "00000000"), (A, pairs[1][1])]) == [f]
+
+
+def test_source_hash_same_qualname(tmp_path):
+    import hashlib
+    import importlib.util
+
+    # Two definitions of A in one file, with different sources
+    source = tmp_path / "redefined_classes.py"
+    source.write_text(
+        "if True:\n"
+        "    class A:\n"
+        "        def f(self):\n"
+        "            return 1\n"
+        "First = A\n"
+        "keep = lambda cls: cls\n"
+        "@keep\n"
+        "class A:\n"
+        "    def f(self):\n"
+        "        return 2\n"
+    )
+    spec = importlib.util.spec_from_file_location("redefined_classes", source)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["redefined_classes"] = module
+    try:
+        spec.loader.exec_module(module)
+        lines = source.read_text().splitlines(keepends=True)
+        for cls, block in ((module.First, lines[1:4]), (module.A, lines[6:])):
+            expected = hashlib.md5("".join(block).encode("utf-8")).hexdigest()
+            assert dowhen.get_source_hash(cls) == expected[-8:]
+        assert dowhen.get_source_hash(module.First) != dowhen.get_source_hash(module.A)
+    finally:
+        del sys.modules["redefined_classes"]
+
 
 def test_should_fire():
     def f(x):
@@ -354,6 +472,252 @@ def test_has_event():
     assert trigger.has_event(frame) is True
 
 
+def test_global_line_number_cache():
+    src = "def f(x):\n    x += 1\n    return x\n"
+    namespace = {}
+    exec(compile(src, "<string>", "exec"), namespace)
+    f = namespace["f"]
+
+    frame = sys._getframe()
+    trigger = dowhen.when(None, "assert", "trigger")
+    assert trigger.has_event(frame) is True
+    assert trigger._global_line_numbers[id(frame.f_code)]
+
+    def g():
+        return sys._getframe()
+
+    assert trigger.has_event(g()) is False
+    assert trigger._global_line_numbers[id(g.__code__)] == frozenset()
+
+    code_id = id(f.__code__)
+    trigger._resolve_global_line_numbers(f.__code__)
+    assert code_id in trigger._global_line_numbers
+    del f, namespace
+    gc.collect()
+    assert code_id not in trigger._global_line_numbers
+
+
+def test_line_index():
+    def f(x):
+        def g():
+            return x
+
+        x += 1
+        return g
+
+    index = dowhen.util.get_line_index(f.__code__)
+    g_code = f(0).__code__
+    first_line = f.__code__.co_firstlineno
+    assert index.line_codes[first_line + 2] == [
+        dowhen.util.get_all_code_objects(f.__code__).index(g_code)
+    ]
+    assert index.stripped_lines[4] == "x += 1"
+
+    assert dowhen.util.get_line_numbers(f.__code__, "return") == {
+        f.__code__: [first_line + 5],
+        g_code: [first_line + 2],
+    }
+    assert dowhen.util.get_line_numbers(f.__code__, ("return", "return x")) == {
+        g_code: [first_line + 2]
+    }
+    assert dowhen.util.get_line_numbers(f.__code__, ("return", "x += 1")) == {}
+    # The index is shared by all the identifiers of the same code object
+    assert dowhen.util.get_line_index(f.__code__) is index
+
+
+def test_weak_lru_cache():
+    from dowhen.util import weak_lru_cache
+
+    calls = []
+
+    @weak_lru_cache(maxsize=2)
+    def name(func, suffix=""):
+        calls.append(func)
+        return func.__name__ + suffix
+
+    def f():
+        pass
+
+    def g():
+        pass
+
+    assert name(f) == "f"
+    assert name(f) == "f"
+    assert name(f, "!") == "f!"
+    assert calls == [f, f]
+    assert name.cache_info() == (1, 2, 2, 2)
+
+    # The least recently used entry is evicted
+    assert name(g) == "g"
+    assert name.cache_info().currsize == 2
+    name(f)
+    assert calls == [f, f, g, f]
+
+    # Entries are evicted when the function is garbage collected
+    calls.clear()
+    del f
+    gc.collect()
+    assert name.cache_info().currsize == 1
+    name(g)
+    assert name.cache_info().currsize == 1
+
+    class A:
+        def method(self):
+            pass
+
+    # Bound methods are anchored on the function
+    assert name(A().method) == "method"
+    assert name(A().method) == "method"
+    assert len(calls) == 1
+
+    name.maxsize = 1
+    assert name.cache_info().currsize == 1
+    name.cache_clear()
+    assert name.cache_info() == (0, 0, 1, 0)
+
+
+def test_source_file_cache(tmp_path):
+    import hashlib
+    import importlib.util
+    import inspect
+    import os
+
+    from dowhen.util import get_source_file, getrealsourcelines, getsourcelines
+
+    path = tmp_path / "source_cache_module.py"
+    path.write_text(
+        "import functools\n"
+        "\n"
+        "@functools.lru_cache\n"
+        "def f(x):\n"
+        "    return x\n"
+        "\n"
+        "class A:\n"
+        "    def g(self):\n"
+        "        return lambda: 1\n"
+    )
+    spec = importlib.util.spec_from_file_location("source_cache_module", path)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    for obj in (module.f, module.A.g, module.A().g, module.A.g.__code__):
+        assert getsourcelines(obj) == inspect.getsourcelines(obj)
+        source = inspect.getsource(obj)
+        expected_hash = hashlib.md5(source.encode("utf-8")).hexdigest()[-8:]
+        assert dowhen.get_source_hash(obj) == expected_hash
+    lam = module.A().g()
+    assert getsourcelines(lam) == inspect.getsourcelines(lam)
+    assert getrealsourcelines(module.f) == (["def f(x):\n", "    return x\n"], 4)
+
+    source_file = get_source_file(str(path))
+    assert source_file is not None
+    assert get_source_file(str(path)) is source_file
+
+    stat = os.stat(path)
+    path.write_text(path.read_text().replace("return x", "return x + 1"))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    # Changed size invalidates the cache
+    new_source_file = get_source_file(str(path))
+    assert new_source_file is not source_file
+    assert getsourcelines(module.f)[0][-1] == "    return x + 1\n"
+
+
+def test_lazy_target(tmp_path, monkeypatch):
+    from dowhen.importhook import ImportHook
+
+    (tmp_path / "lazy_target_module.py").write_text(
+        "class A:\n    def f(self, x):\n        return x\n\n\ndef g(x):\n    return x\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "lazy_target_module", raising=False)
+
+    handler_f = dowhen.when("lazy_target_module:A.f", "return x").do("x = 1")
+    handler_g = dowhen.when("lazy_target_module:g", "return x").do("x = 2")
+    handler_removed = dowhen.when("lazy_target_module:g", "<start>").do("x = 3")
+    handler_missing = dowhen.when("lazy_target_module:h", "return x").do("x = 4")
+    assert "lazy_target_module" not in sys.modules
+    assert ImportHook() in sys.meta_path
+    handler_removed.remove()
+
+    with pytest.warns(RuntimeWarning, match="lazy_target_module:h"):
+        import lazy_target_module  # type: ignore
+
+    assert ImportHook() not in sys.meta_path
+    assert isinstance(
+        lazy_target_module.__loader__, importlib.machinery.SourceFileLoader
+    )
+    assert lazy_target_module.A().f(0) == 1
+    assert lazy_target_module.g(0) == 2
+    handler_f.remove()
+    handler_g.remove()
+    handler_missing.remove()
+    assert lazy_target_module.g(0) == 0
+
+    # Targets of imported modules are resolved right away
+    with dowhen.when("lazy_target_module:g", "return x").do("x = 5"):
+        assert lazy_target_module.g(0) == 5
+    with dowhen.when("lazy_target_module", "return x").do("x = 6"):
+        assert lazy_target_module.g(0) == 6
+
+    with pytest.raises(ValueError):
+        dowhen.when("lazy_target_module:h", "return x")
+
+    trigger = dowhen.when("lazy_target_module_missing:f", "return x")
+    assert trigger.events == []
+    assert trigger.target == "lazy_target_module_missing:f"
+
+
+def test_recursive(tmp_path, monkeypatch):
+    package = tmp_path / "recursive_package"
+    package.mkdir()
+    (package / "__init__.py").write_text("from os.path import join\n")
+    (package / "mod.py").write_text(
+        "import functools\n"
+        "\n"
+        "class A:\n"
+        "    class B:\n"
+        "        @staticmethod\n"
+        "        def f(x):\n"
+        "            return x\n"
+        "\n"
+        "    @property\n"
+        "    def p(self):\n"
+        "        x = 0\n"
+        "        return x\n"
+        "\n"
+        "@functools.cache\n"
+        "def g(x):\n"
+        "    def h():\n"
+        "        return x\n"
+        "    return h()\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import recursive_package.mod  # type: ignore
+
+    mod = recursive_package.mod
+    with dowhen.when(recursive_package, "return x", recursive=True).do("x = 1"):
+        assert mod.A.B.f(0) == 1
+        assert mod.A().p == 1
+        assert mod.g(0) == 1
+
+    codes = dowhen.trigger.Trigger._get_code_recursively(recursive_package)
+    assert len(codes) == 4
+    assert len(dowhen.trigger.Trigger._get_code_recursively(mod.A)) == 2
+
+    with dowhen.when(mod.A, "<start>", recursive=True).do("x = 2") as handler:
+        assert {event.code for event in handler.trigger.events} == {
+            mod.A.B.f.__code__,
+            mod.A.p.fget.__code__,
+        }
+
+    with pytest.raises(TypeError):
+        dowhen.when(mod.g, "return x", recursive=True)
+
+    with pytest.raises(ValueError):
+        dowhen.when(mod, "nothing", recursive=True)
+
+
 def test_invalid_type():
     def f():
         pass